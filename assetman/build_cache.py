@@ -0,0 +1,155 @@
+import os
+import json
+import logging
+import threading
+
+from assetman.tools import atomic_write, get_hash_algorithm
+
+
+class BuildCache(object):
+    """A persistent cache of per-file build information, stored next to the
+    manifest, which lets the compiler skip re-reading files that have not
+    changed since the last build.
+
+    Each entry is keyed on a file's path and is only considered valid while
+    the file's (size, mtime_ns, inode) still match. Entries hold the file's
+    content hash and the results of scanning it for dependencies (see
+    `assetman.compile.FileScan`): its first-level deps and any referenced
+    paths which were missing. A scan is also discarded if any of its deps
+    have disappeared or any of its missing paths have appeared.
+
+    The whole cache is discarded if it was built with a different
+    static_dir or static_url_prefix, since both affect dependency scanning,
+    or with a different hash algorithm.
+    """
+
+    VERSION = 2
+
+    def __init__(self, settings, path=None):
+        self.settings = settings
+        self.path = path or self.get_path(settings['compiled_asset_root'])
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get_path(cls, compiled_asset_root):
+        return os.path.join(compiled_asset_root, 'build_cache.json')
+
+    def get_params(self):
+        return {
+            'version': self.VERSION,
+            'static_dir': os.path.abspath(self.settings['static_dir']),
+            'static_url_prefix': self.settings['static_url_prefix'],
+            'hash_algorithm': get_hash_algorithm(self.settings),
+        }
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            assert isinstance(data, dict)
+            if data.get('params') != self.get_params():
+                logging.info('Build cache %s is for different settings; ignoring it', self.path)
+            else:
+                self._entries = data['entries']
+                assert isinstance(self._entries, dict)
+        except (AssertionError, KeyError, IOError, ValueError) as e:
+            logging.info('Not using build cache %s: %s', self.path, e)
+            self._entries = {}
+        return self
+
+    def save(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            return
+        logging.info('Writing build cache to %s (%d hits, %d misses)', self.path, self.hits, self.misses)
+        with self._lock:
+            data = {'params': self.get_params(), 'entries': self._entries}
+            with atomic_write(self.path) as f:
+                json.dump(data, f, separators=(',', ':'))
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _stat_key(self, path):
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def _get(self, path, field, compute):
+        """Returns the cached value of field for the file at path, calling
+        compute() to (re)fill it if the file changed or it is missing.
+        """
+        stat_key = self._stat_key(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry['stat'] == stat_key and field in entry:
+                self.hits += 1
+                return entry[field]
+            self.misses += 1
+        value = compute()
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or entry['stat'] != stat_key:
+                entry = self._entries[path] = {'stat': stat_key}
+            entry[field] = value
+        return value
+
+    def get_file_hash(self, path, compute):
+        return self._get(path, 'hash', compute)
+
+    def get_scan(self, path, compute):
+        """Returns a (hash, deps, missing) tuple for the file at path, calling
+        compute() to scan it if the cached scan is out of date.
+        """
+        stat_key = self._stat_key(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry['stat'] == stat_key and 'deps' in entry:
+                deps, missing = entry['deps'], entry['missing']
+            else:
+                deps = None
+        if deps is not None and all(map(os.path.isfile, deps)) and not any(map(os.path.isfile, missing)):
+            with self._lock:
+                self.hits += 1
+            return entry['hash'], deps, missing
+        with self._lock:
+            self.misses += 1
+        file_hash, deps, missing = scan = compute()
+        with self._lock:
+            self._entries[path] = {
+                'stat': stat_key,
+                'hash': file_hash,
+                'deps': list(deps),
+                'missing': list(missing),
+            }
+        return scan
+
+    def validate(self, get_file_hash):
+        """Checks every entry in the cache that claims to be fresh against
+        the file on disk, using get_file_hash to hash it. Returns a list of
+        paths whose cached hash is wrong; stale entries (whose files changed
+        or were removed) are not errors and are dropped.
+        """
+        invalid = []
+        with self._lock:
+            entries = list(self._entries.items())
+        for path, entry in entries:
+            try:
+                stat_key = self._stat_key(path)
+            except OSError:
+                stat_key = None
+            if stat_key != entry['stat']:
+                with self._lock:
+                    self._entries.pop(path, None)
+                continue
+            if 'hash' in entry and entry['hash'] != get_file_hash(path):
+                logging.error('Build cache entry for %s has the wrong hash', path)
+                invalid.append(path)
+                with self._lock:
+                    self._entries.pop(path, None)
+        return invalid
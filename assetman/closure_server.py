@@ -0,0 +1,117 @@
+import os
+import time
+import socket
+import logging
+import subprocess
+
+
+class ClosureServer(object):
+    """A long-lived Closure Compiler JVM, shared by every JS block compiled
+    during a single run so that JVM startup and JIT warm-up are paid once
+    rather than once per block.
+
+    The JVM runs a Nailgun server (https://github.com/facebook/nailgun) with
+    the closure compiler on its classpath, and JS blocks are compiled by
+    running the lightweight `ng` client in place of `java -jar`. It is
+    enabled by the `closure_nailgun_jar` setting, which should point at the
+    nailgun-server jar; the `nailgun_client` setting names the client binary
+    (default `ng`).
+
+        with ClosureServer(settings) as server:
+            cmd = server.get_command() + ['--js', 'foo.js']
+    """
+
+    main_class = 'com.google.javascript.jscomp.CommandLineRunner'
+    default_server_class = 'com.facebook.nailgun.NGServer'
+
+    def __init__(self, settings, host='127.0.0.1'):
+        self.settings = settings
+        self.host = host
+        self.port = None
+        self.proc = None
+
+    @classmethod
+    def is_enabled(cls, settings):
+        return bool(settings.get('closure_nailgun_jar'))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def __str__(self):
+        return '<ClosureServer %s:%s>' % (self.host, self.port)
+
+    def get_free_port(self):
+        sock = socket.socket()
+        try:
+            sock.bind((self.host, 0))
+            return sock.getsockname()[1]
+        finally:
+            sock.close()
+
+    def start(self, timeout=30):
+        """Starts the server JVM and waits for it to accept connections.
+        Returns True if it is ready, or False (after logging why) if it could
+        not be started, in which case callers should fall back to running the
+        compiler directly.
+        """
+        self.port = self.get_free_port()
+        classpath = [self.settings['closure_nailgun_jar'], self.settings['closure_compiler']]
+        cmd = [
+            self.settings['java_bin'], '-Xss16m', '-cp', os.pathsep.join(classpath),
+            self.settings.get('nailgun_server_class') or self.default_server_class,
+            '%s:%d' % (self.host, self.port),
+        ]
+        logging.info('Starting closure compiler server: %s', ' '.join(cmd))
+        try:
+            self.proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            logging.warning('Could not start closure compiler server: %s', e)
+            self.proc = None
+            return False
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                logging.warning('Closure compiler server exited with %s', self.proc.returncode)
+                self.proc = None
+                return False
+            try:
+                socket.create_connection((self.host, self.port), timeout=1).close()
+            except socket.error:
+                time.sleep(0.1)
+                continue
+            logging.info('Closure compiler server ready on port %d', self.port)
+            return True
+        logging.warning('Closure compiler server did not start within %ds', timeout)
+        self.stop()
+        return False
+
+    def is_running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def stop(self):
+        if self.proc is None:
+            return
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        self.proc = None
+
+    def get_command(self):
+        """Returns the command prefix that runs the closure compiler in this
+        server, to which compiler arguments should be appended.
+        """
+        assert self.port is not None
+        return [
+            self.settings.get('nailgun_client') or 'ng',
+            '--nailgun-server', self.host,
+            '--nailgun-port', str(self.port),
+            self.main_class,
+        ]
@@ -4,15 +4,29 @@
 
 import os
 import re
+import sys
+import mmap
+import time
 import logging
+import functools
+import traceback
+import contextlib
+import collections
 import multiprocessing
+import concurrent.futures
 import hashlib
 
 from optparse import OptionParser
 
-from assetman.manifest import Manifest 
-from assetman.tools import iter_template_paths, get_static_pattern, make_relative_static_path, make_absolute_static_path, get_parser
-from assetman.compilers import DependencyError, ParseError, CompileError
+from assetman.manifest import Manifest, RuntimeManifest
+from assetman.manifest_index import ManifestIndex
+from assetman.build_cache import BuildCache
+from assetman.compile_stats import CompileStats
+from assetman.tools import iter_template_paths, get_static_pattern, make_relative_static_path, make_absolute_static_path, get_parser, atomic_write, new_hash, get_hash_algorithm, check_hash_algorithm
+from assetman.compilers import DependencyError, ParseError, CompileError, JSCompiler, CSSCompiler, get_lessc_threads
+from assetman.disk_cache import DiskCache, DEFAULT_MAX_AGE
+from assetman.closure_server import ClosureServer
+from assetman.jobserver import JobServer, set_jobserver
 from assetman.S3UploadThread import upload_assets_to_s3
 
 from assetman.settings import Settings
@@ -50,6 +64,59 @@ parser.add_option(
     '--compiled-manifest-path', type="string", default="/",
     help="Location to read/write the compiled asset manifest")
 
+parser.add_option(
+    '-j', '--jobs', type="int",
+    help='Number of worker processes for parsing and compiling (default: one per CPU). '
+         'Use 1 to parse templates serially, which is easier to debug.')
+
+parser.add_option(
+    '--scan-threads', type="int",
+    help='Number of threads used to read, hash and scan static files for dependencies '
+         '(default: 1, ie serially). More threads only help when reading files is slow, '
+         'eg on a network filesystem.')
+
+parser.add_option(
+    '--closure-nailgun-jar', type="string",
+    help='Path to a nailgun-server jar. If given, JS blocks are compiled in one long-lived '
+         'closure compiler JVM instead of a new JVM per block.')
+
+parser.add_option(
+    '--nailgun-client', type="string", default="ng",
+    help='Nailgun client binary used with --closure-nailgun-jar (default: ng).')
+
+parser.add_option(
+    '--closure-batch-size', type="int",
+    help='Compile up to this many JS blocks in each closure compiler run, as separate chunks.')
+
+parser.add_option(
+    '--closure-chunk-flag', type="string",
+    help='Closure compiler flag for declaring the chunks of a batch (default: --module, '
+         'newer releases also accept --chunk).')
+
+parser.add_option(
+    '--lessc-threads', type="int",
+    help='Number of lessc processes each Less block may run at once '
+         '(default: the number of CPUs divided by --jobs).')
+
+parser.add_option(
+    '--max-tool-procs', type="int",
+    help='Maximum number of external tool processes (java, lessc, minify, ...) to run at once '
+         'across all workers.')
+
+parser.add_option(
+    '--tool-proc-limit', type="string", action='append', default=[],
+    help='Per-tool process limit, as TOOL=N where TOOL is the executable name (eg java=2). '
+         'May be given more than once.')
+
+parser.add_option(
+    '--hash-algorithm', type="string", default="md5",
+    help='Hash algorithm used to version assets, any supported by hashlib (default: md5). '
+         'Changing it forces a full rebuild.')
+
+parser.add_option(
+    '--hash-digest-size', type="int",
+    help='Digest size in bytes, for hash algorithms that support it (eg blake2b).')
+
 parser.add_option(
     '-t', '--test-needs-compile', action="store_true",
     help='Check whether a compile is needed. Exits 1 if so.')
@@ -58,10 +125,42 @@ parser.add_option(
     '-f', '--force-recompile', action="store_true",
     help='Force a recompile of everything.')
 
+parser.add_option(
+    '-k', '--keep-going', action="store_true",
+    help='Keep compiling after a block fails, and record the blocks that succeeded in the manifest.')
+
 parser.add_option(
     '-i', '--skip-inline-images', action="store_true",
     help='Do not sub data URIs for small images in CSS.')
 
+parser.add_option(
+    '--compact-manifest', action="store_true",
+    help='Write the manifest without indentation (faster for large manifests).')
+
+parser.add_option(
+    '--skip-build-cache', action="store_true",
+    help='Do not read or write the cache of file hashes and dependencies.')
+
+parser.add_option(
+    '--rebuild-build-cache', action="store_true",
+    help='Ignore the existing build cache and rebuild it from scratch.')
+
+parser.add_option(
+    '--validate-build-cache', action="store_true",
+    help='Check every build cache entry against the file on disk and exit. Exits 1 if any are wrong.')
+
+parser.add_option(
+    '--skip-minify-cache', action="store_true",
+    help='Minify each CSS block as a whole instead of using the cache of minified files.')
+
+parser.add_option(
+    '--cache-dir', type="string",
+    help='Directory for caches of compiler output, like minified CSS (default: the output dir).')
+
+parser.add_option(
+    '--cache-max-age', type="float",
+    help='Remove cached compiler output unused for this many days (default: 7).')
+
 parser.add_option(
     '--skip-s3-upload', action="store_true",
     help='Skip uploading anything to s3')
@@ -91,56 +190,147 @@ static_url_call_finder = re.compile(r'assetman\.static_url\((.*?)(,.*?)?\)').fin
 # Multiprocessing workers
 ##############################################################################
 class ParserWorker(object):
-    def __init__(self, settings):
+    def __init__(self, settings, wrap_errors=False):
         self.settings = settings
+        self.wrap_errors = wrap_errors
 
     def __call__(self, template_info):
         """Takes a template path and returns a list of AssetCompiler instances
         extracted from that template. Helper function to be called by each process
-        in the process pool created by find_assetman_compilers, above.
+        in the process pool created by build_compilers, below.
+
+        If wrap_errors is True (as it is in the process pool, where tracebacks
+        would otherwise be lost), any error is re-raised as a ParseError or
+        DependencyError carrying the template path, with the worker's
+        formatted traceback in its `traceback` attribute.
         """
         assert isinstance(template_info, (list, tuple))
         template_path, template_type = template_info
-        template = get_parser(template_path, template_type, self.settings)
-        return list(template.get_compilers())
+        try:
+            template = get_parser(template_path, template_type, self.settings)
+            return list(template.get_compilers())
+        except (ParseError, DependencyError) as e:
+            if self.wrap_errors:
+                e.traceback = traceback.format_exc()
+            raise
+        except Exception as e:
+            if not self.wrap_errors:
+                raise
+            error = ParseError(template_path, '%s: %s' % (e.__class__.__name__, e))
+            error.traceback = traceback.format_exc()
+            raise error
+
+# The outcome of compiling one block: its name hash, a description, how long
+# it took, and the (cmd, msg) of its error if it failed (cmd is empty for
+# errors other than a failed tool run).
+CompileResult = collections.namedtuple('CompileResult', ['name_hash', 'name', 'duration', 'error'])
 
 class CompileWorker(object):
-    """Takes an AssetCompiler and, based on the manifest, compiles the assets,
+    """Takes an AssetCompiler and, based on its manifest, compiles the assets,
     writing the results to disk. Used as a helper function when compiling
     assets in parallel.
     """
-    def __init__(self, skip_inline_images, manifest):
-        self.manifest = manifest
+    def __init__(self, skip_inline_images, closure_command=None, lessc_threads=None, keep_going=False):
         self.skip_inline_images = skip_inline_images
+        self.closure_command = closure_command
+        self.lessc_threads = lessc_threads
+        self.keep_going = keep_going
 
     def __call__(self, compiler):
-        with open(compiler.get_compiled_path(), 'w') as outfile:
-            outfile.write(compiler.compile(skip_inline_images=self.skip_inline_images))
+        """Compiles the given compiler (or batch of JSCompilers), returning a
+        CompileResult for each block compiled.
+
+        An error is raised as soon as any block fails, unless keep_going is
+        set, in which case the error's (cmd, msg) is returned in the failed
+        block's result instead.
+        """
+        start = time.time()
+        if isinstance(compiler, list):
+            compilers = compiler
+            errors = self.compile_js_batch(compilers)
+        else:
+            compilers = [compiler]
+            errors = {compiler.get_hash(): self.compile(compiler)}
+        # Batched blocks are charged an equal share of the batch's time
+        duration = (time.time() - start) / len(compilers)
+        return [CompileResult(c.get_hash(), str(c), duration, errors.get(c.get_hash())) for c in compilers]
+
+    def compile(self, compiler):
+        """Compiles a single block, returning None or, if keep_going is set
+        and compiling fails, the CompileError's (cmd, msg). Any other error
+        (eg, an AssertionError for a missing input file) is returned as
+        ([], msg).
+        """
+        try:
+            compiler.compile_to_file(compiler.get_compiled_path(),
+                                     skip_inline_images=self.skip_inline_images,
+                                     closure_command=self.closure_command,
+                                     lessc_threads=self.lessc_threads)
+        except CompileError as e:
+            if not self.keep_going:
+                raise
+            logging.error('Compile error in %s, continuing', compiler)
+            return e.args
+        except Exception as e:
+            if not self.keep_going:
+                raise
+            logging.exception('Error compiling %s, continuing', compiler)
+            return [], '%s: %s' % (e.__class__.__name__, e)
+        return None
+
+    def compile_js_batch(self, compilers):
+        """Compiles a batch of JSCompilers in one closure compiler run (see
+        batch_js_compilers). If the batch fails, each block is compiled on its
+        own, so that any error is reported against the block that caused it.
+        Returns a dict of the errors returned by compile, by name hash.
+        """
+        try:
+            with contextlib.ExitStack() as stack:
+                outfiles = [stack.enter_context(atomic_write(compiler.get_compiled_path(), 'wb'))
+                            for compiler in compilers]
+                JSCompiler.compile_batch(compilers, closure_command=self.closure_command, outfiles=outfiles)
+        except Exception as e:
+            logging.warning('Batch of %d JS blocks failed, compiling them separately: %s', len(compilers), e)
+            return dict((compiler.get_hash(), self.compile(compiler)) for compiler in compilers)
+        return {}
 
 
 ##############################################################################
 # Compiler support functions
 ##############################################################################
-def get_file_hash(path, block_size=8192):
-    """Calculates the content hash for the file at the given path."""
-    md5 = hashlib.md5()
+# Files at least this big are hashed through mmap rather than read()
+mmap_hash_threshold = 1 << 20
+
+def get_file_hash(path, settings=None):
+    """Calculates the content hash for the file at the given path, using the
+    hash algorithm configured by settings. Small files are read in one go;
+    large ones are mapped into memory and hashed without copying them
+    through Python.
+    """
+    h = new_hash(settings)
     with open(path, 'rb') as f:
-        while True:
-            block = f.read(block_size)
-            if not block:
-                break
-            md5.update(block)
-    return md5.hexdigest()
+        if os.fstat(f.fileno()).st_size < mmap_hash_threshold:
+            h.update(f.read())
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                h.update(m)
+    return h.hexdigest()
 
 ##############################################################################
 # Build and compare dependency manifests
 ##############################################################################
-def static_finder(s, static_url_prefix):
-    pattern = get_static_pattern(static_url_prefix)
-    return re.compile(pattern).finditer(s)
+# CSS/Less/Sass imports look like @import "foo.css" or @import url('foo.css')
+import_finder = re.compile(r"""@import (url\()?(["'])(.*?)(\2)""").finditer
 
-def import_finder(s):
-    return re.compile(r"""@import (url\()?(["'])(.*?)(\2)""").finditer(s)
+@functools.lru_cache(maxsize=None)
+def get_static_finder(static_url_prefix):
+    """Returns a finditer function for static asset references starting
+    with the given prefix, compiling the pattern only once per prefix.
+    """
+    return re.compile(get_static_pattern(static_url_prefix)).finditer
+
+def static_finder(s, static_url_prefix):
+    return get_static_finder(static_url_prefix)(s)
 
 def empty_asset_entry():
     """This is the form of each 'assets' entry in the manifest as we're
@@ -156,91 +346,122 @@ def build_compilers(path_infos, settings):
     """Parse each template and return a list of AssetCompiler instances for
     any assetman.include_* blocks in each template.
     """
-    # pool.map will not ordinarily handle KeyboardInterrupts cleanly,
-    # but if you give them a timeout they will. More info:
-    # http://bugs.python.org/issue8296
-    # http://stackoverflow.com/a/1408476/151221
-
-    parser_worker = ParserWorker(settings)
-    # a sync version for easier debugging (to see exceptions)
-    compiler_lists = [parser_worker(x) for x in path_infos]
+    jobs = settings.get('jobs') or multiprocessing.cpu_count()
+    if jobs == 1 or len(path_infos) <= 1:
+        # a sync version for easier debugging (to see exceptions)
+        parser_worker = ParserWorker(settings)
+        compiler_lists = [parser_worker(x) for x in path_infos]
+    else:
+        # Hand out templates in a few chunks per worker, which keeps IPC
+        # overhead low while still balancing uneven template sizes.
+        chunksize = max(1, len(path_infos) // (jobs * 4))
+        parser_worker = ParserWorker(settings, wrap_errors=True)
+        pool = multiprocessing.Pool(jobs)
+        try:
+            # pool.map will not ordinarily handle KeyboardInterrupts cleanly,
+            # but if you give them a timeout they will. More info:
+            # http://bugs.python.org/issue8296
+            # http://stackoverflow.com/a/1408476/151221
+            compiler_lists = pool.map_async(parser_worker, path_infos, chunksize).get(1e9)
+        finally:
+            pool.terminate()
+            pool.join()
     output = [item for sublist in compiler_lists for item in sublist]
     return output
-    # pool = multiprocessing.Pool()
-    # return [x for xs in pool.map_async(parser_worker, path_infos).get(1e100) for x in xs]
 
 
-def iter_template_deps(static_dir, src_path, static_url_prefix):
-    """Yields static resources included as {{assetman.static_url()}} calls
-    in the given source path, which should be a Tornado template.
+###############################################################################
 
-    TODO: need one of these for every supported template language?
+def topological_order(assets, paths=None):
+    """Returns the given asset paths (or every asset in the manifest) along
+    with all of their transitive deps, ordered so that each path comes after
+    all of its deps. The graph is walked with an explicit stack, so deep
+    dependency chains are fine, but a cycle raises a DependencyError naming
+    every path in it.
     """
-    src = open(src_path).read()
-    for match in static_url_call_finder(src):
-        arg = match.group(1)
-        quotes = '\'"'
-        if arg[0] not in quotes or arg[-1] not in quotes:
-            msg = 'Vars not allowed in static_url calls: %s' % match.group(0)
-            raise ParseError(src_path, msg)
-        else:
-            dep_path = make_absolute_static_path(static_dir, arg.strip(quotes))
-            if os.path.isfile(dep_path):
-                yield dep_path
+    order = []
+    done = set()
+    for root in sorted(assets if paths is None else paths):
+        if root in done:
+            continue
+        # Each stack item is a path and an iterator over its remaining deps
+        stack = [(root, iter(sorted(assets[root]['deps'])))]
+        in_progress = {root: 0}
+        while stack:
+            path, deps = stack[-1]
+            for dep in deps:
+                if dep in done:
+                    continue
+                if dep in in_progress:
+                    cycle = [p for p, _ in stack[in_progress[dep]:]] + [dep]
+                    raise DependencyError(dep, 'dependency cycle: %s' % ' -> '.join(cycle))
+                assert dep in assets, (path, dep)
+                in_progress[dep] = len(stack)
+                stack.append((dep, iter(sorted(assets[dep]['deps']))))
+                break
             else:
-                logging.warning('Missing dep %s (src: %s)', dep_path, src_path)
+                stack.pop()
+                del in_progress[path]
+                done.add(path)
+                order.append(path)
+    return order
 
-###############################################################################
 
-def version_dependency(path, manifest):
-    """A dependency's version is calculated using this recursive formula:
+def version_dependencies(manifest, build_cache=None, file_hashes=None, paths=None):
+    """Calculates the version of every asset in the manifest (or just the
+    given paths and their deps) using this formula:
 
-        version = md5(md5(path_contents) + version(deps))
+        version = hash(hash(path_contents) + version(deps))
 
     So, the version of a path is based on the hash of its own file contents as
-    well as those of each of its dependencies.
-    """
-    assert path in manifest.assets, path
-    if manifest.assets[path]['version']:
-        return manifest.assets[path]['version']
-    h = hashlib.md5()
-    h.update(get_file_hash(make_absolute_static_path(manifest.settings['static_dir'], path)).encode())
-    for dep_path in manifest.assets[path]['deps']:
-        h.update(version_dependency(dep_path, manifest).encode())
-    version = h.hexdigest()
-    _, ext = os.path.splitext(path)
-    manifest.assets[path]['version'] = version
-    manifest.assets[path]['versioned_path'] = version + ext
-    return manifest.assets[path]['version']
-
-
-def iter_deps(static_dir, src_path, static_url_prefix):
-    """Yields first-level dependencies from the given source path."""
-    assert os.path.isfile(src_path), src_path
-    dep_iter = {
-        '.js': iter_js_deps,
-        '.css': iter_css_deps,
-        '.less': iter_css_deps,
-        '.scss': iter_scss_deps,
-        '.html': iter_template_deps,
-        }.get(os.path.splitext(src_path)[1])
-    if dep_iter:
-        for path in dep_iter(static_dir, src_path, static_url_prefix):
-            yield path
+    well as those of each of its dependencies, using the hash algorithm
+    configured by the manifest's settings. Versions are computed in
+    topological order, so each asset's deps are always versioned first.
+    Content hashes already computed while scanning can be passed in
+    file_hashes, keyed on path.
 
-def iter_css_deps(static_dir, src_path, static_url_prefix):
-    """Yields first-level dependencies from the given source path, which
-    should be a CSS, Less, or Sass file. Dependencies will either be more
-    CSS/Less/Sass files or static image resources.
+    Returns the list of paths that were versioned.
     """
-    assert os.path.isfile(src_path), src_path
-    root = os.path.dirname(src_path)
-    src = open(src_path).read()
+    assets = manifest.assets
+    versioned = []
+    for path in topological_order(assets, paths):
+        entry = assets[path]
+        if entry['version']:
+            continue
+        if file_hashes is not None and path in file_hashes:
+            file_hash = file_hashes[path]
+        else:
+            abs_path = make_absolute_static_path(manifest.settings['static_dir'], path)
+            file_hash = get_cached_file_hash(abs_path, build_cache, manifest.settings)
+        h = new_hash(manifest.settings, file_hash.encode())
+        for dep_path in sorted(entry['deps']):
+            h.update(assets[dep_path]['version'].encode())
+        version = h.hexdigest()
+        _, ext = os.path.splitext(path)
+        entry['version'] = version
+        entry['versioned_path'] = version + ext
+        versioned.append(path)
+    return versioned
+
+
+def _iter_template_refs(static_dir, src_path, src):
+    for match in static_url_call_finder(src):
+        arg = match.group(1)
+        quotes = '\'"'
+        if arg[0] not in quotes or arg[-1] not in quotes:
+            msg = 'Vars not allowed in static_url calls: %s' % match.group(0)
+            raise ParseError(src_path, msg)
+        yield make_absolute_static_path(static_dir, arg.strip(quotes))
 
-    # First look for CSS/Less imports and recursively descend into them
+def _iter_import_refs(src_path, src):
+    root = os.path.dirname(src_path)
+    is_less = src_path.endswith('.less')
+    is_scss = src_path.endswith('.scss')
     for match in import_finder(src):
         path = match.group(3)
-        if src_path.endswith('.less') and os.path.splitext(path)[1] == '':
+        if is_scss and path.startswith('compass/'):
+            continue
+        if is_less and os.path.splitext(path)[1] == '':
             path = path + '.less'
         # normpath will take care of '../' path components
         new_root = os.path.normpath(os.path.join(root, os.path.dirname(path)))
@@ -249,66 +470,111 @@ def iter_css_deps(static_dir, src_path, static_url_prefix):
         assert os.path.isfile(full_path), full_path
         yield full_path
 
-    # Then look for static assets (images, basically)
-    for dep in iter_static_deps(static_dir, src_path, static_url_prefix):
-        yield dep
+def _iter_static_refs(static_dir, src, static_url_prefix):
+    for match in static_finder(src, static_url_prefix):
+        yield make_absolute_static_path(static_dir, match.group(2))
 
-def iter_scss_deps(src_path):
-    """Yields first-level dependencies from the given source path, which
-    should be a Sass file. Dependencies will either be more
-    Sass files or static image resources.
+def _iter_refs(static_dir, src_path, src, static_url_prefix):
+    """Yields every path referenced by the given source, whether or not it
+    exists, based on the source's file type.
     """
-    assert os.path.isfile(src_path), src_path
-    root = os.path.dirname(src_path)
-    src = open(src_path).read()
-
-    # First look for CSS/Less imports and recursively descend into them
-    for match in import_finder(src):
-        path = match.group(3)
-        if path.startswith('compass/'):
-            continue
-        # normpath will take care of '../' path components
-        new_root = os.path.normpath(os.path.join(root, os.path.dirname(path)))
-        full_path = os.path.join(new_root, os.path.basename(path))
-        assert os.path.isdir(new_root), new_root
-        assert os.path.isfile(full_path), full_path
-        yield full_path
-
-    # Then look for static assets (images, basically)
-    for dep in iter_static_deps(src_path):
-        yield dep
+    ext = os.path.splitext(src_path)[1]
+    if ext in ('.css', '.less', '.scss'):
+        # First look for CSS/Less/Sass imports, then for static assets
+        # (images, basically)
+        for path in _iter_import_refs(src_path, src):
+            yield path
+        for path in _iter_static_refs(static_dir, src, static_url_prefix):
+            yield path
+    elif ext == '.js':
+        for path in _iter_static_refs(static_dir, src, static_url_prefix):
+            yield path
+    elif ext == '.html':
+        for path in _iter_template_refs(static_dir, src_path, src):
+            yield path
 
+# The file types which may reference other files
+scanned_extensions = frozenset(['.js', '.css', '.less', '.scss', '.html'])
 
-def iter_js_deps(static_dir, src_path, static_url_prefix):
-    """Yields first-level dependencies from the given source path, which
-    should be a JavaScript file. Dependencies will be static image resources.
-    """
-    return iter_static_deps(static_dir, src_path, static_url_prefix)
+# The result of scanning a single file: its content hash, its first-level
+# dependencies and any referenced paths which don't exist (which would
+# become dependencies if they were created).
+FileScan = collections.namedtuple('FileScan', ['hash', 'deps', 'missing'])
 
-def iter_static_deps(static_dir, src_path, static_url_prefix):
-    """Yields static resources (ie, image files) from the given source path.
+def scan_file(static_dir, src_path, static_url_prefix, settings=None):
+    """Reads the file at src_path once, returning a FileScan with its content
+    hash (using the hash algorithm configured by settings) and dependencies.
     """
     assert os.path.isfile(src_path), src_path
-    for match in static_finder(open(src_path).read(), static_url_prefix):
-        dep_path = make_absolute_static_path(static_dir, match.group(2))
+    if os.path.splitext(src_path)[1] not in scanned_extensions:
+        return FileScan(get_file_hash(src_path, settings), [], [])
+    with open(src_path, 'rb') as f:
+        data = f.read()
+    deps = []
+    missing = []
+    for dep_path in _iter_refs(static_dir, src_path, data.decode('utf-8', 'replace'), static_url_prefix):
         if os.path.isfile(dep_path):
-            yield dep_path
+            deps.append(dep_path)
         else:
             logging.warning('Missing dep %s (src: %s)', dep_path, src_path)
+            missing.append(dep_path)
+    return FileScan(new_hash(settings, data).hexdigest(), deps, missing)
 
+def get_cached_file_hash(path, build_cache=None, settings=None):
+    if build_cache is None:
+        return get_file_hash(path, settings)
+    return build_cache.get_file_hash(path, functools.partial(get_file_hash, path, settings))
 
-def _build_manifest_helper(static_dir, src_paths, static_url_prefix, manifest):
+def get_cached_scan(static_dir, static_url_prefix, build_cache, src_path, settings=None):
+    """Returns the FileScan for src_path, from the build cache if possible.
+    Safe to call from multiple threads at once.
+    """
+    scan = functools.partial(scan_file, static_dir, src_path, static_url_prefix, settings)
+    if build_cache is None:
+        return scan()
+    return FileScan._make(build_cache.get_scan(src_path, scan))
+
+def _build_manifest_helper(static_dir, src_paths, static_url_prefix, manifest, build_cache=None, file_hashes=None, executor=None):
+    """Walks the dependency graph reachable from the given source paths,
+    adding an entry with first-level deps to the manifest for every file
+    found. Each file is scanned exactly once, no matter how many paths in the
+    graph lead to it, and cycles are tolerated. If a BuildCache is given,
+    unchanged files are not re-scanned at all.
+
+    The graph is walked breadth-first. If an executor is given, all of the
+    files at each level are read, hashed and scanned concurrently, which pays
+    off when reading files is slow (eg, on network filesystems). Content
+    hashes are stored in file_hashes, if given, keyed on relative path.
+
+    Returns the number of unique files visited.
+    """
     assert isinstance(src_paths, (list, tuple))
-    for src_path in src_paths:
-        # Make sure every source path at least has the skeleton entry
-        rel_src_path = make_relative_static_path(static_dir, src_path)
-        logging.info('_build_manifest_helper %s (current %s)', src_path, manifest.assets.get(rel_src_path))
-        manifest.assets.setdefault(rel_src_path, empty_asset_entry())
-        for dep_path in iter_deps(static_dir, src_path, static_url_prefix):
-            logging.info('%s > dependency %s', src_path, dep_path)
-            rel_path = make_relative_static_path(static_dir, dep_path)
-            manifest.assets[rel_src_path]['deps'].add(rel_path)
-            _build_manifest_helper(static_dir, [dep_path], static_url_prefix, manifest)
+    visited = set()
+    frontier = src_paths
+    while frontier:
+        to_scan = []
+        for src_path in frontier:
+            rel_src_path = make_relative_static_path(static_dir, src_path)
+            if rel_src_path not in visited:
+                visited.add(rel_src_path)
+                to_scan.append((rel_src_path, src_path))
+        scan = functools.partial(get_cached_scan, static_dir, static_url_prefix, build_cache, settings=manifest.settings)
+        scan_paths = [src_path for _, src_path in to_scan]
+        results = executor.map(scan, scan_paths) if executor else map(scan, scan_paths)
+        frontier = []
+        for (rel_src_path, src_path), (file_hash, deps, _) in zip(to_scan, results):
+            logging.info('_build_manifest_helper %s', src_path)
+            # Make sure every source path at least has the skeleton entry
+            entry = manifest.assets.setdefault(rel_src_path, empty_asset_entry())
+            if file_hashes is not None:
+                file_hashes[rel_src_path] = file_hash
+            for dep_path in deps:
+                logging.info('%s > dependency %s', src_path, dep_path)
+                rel_path = make_relative_static_path(static_dir, dep_path)
+                entry['deps'].add(rel_path)
+                if rel_path not in visited:
+                    frontier.append(dep_path)
+    return len(visited)
 
 
 def build_manifest(tornado_paths, settings):
@@ -331,14 +597,28 @@ def build_manifest(tornado_paths, settings):
         paths.update(new_paths)
     paths = list(paths)
 
+    build_cache = get_build_cache(settings)
+
     # Start building the new manifest
     manifest = Manifest(settings)
-    _build_manifest_helper(settings['static_dir'], paths, settings['static_url_prefix'], manifest)
+    manifest.hash_algorithm = get_hash_algorithm(settings)
+    file_hashes = {}
+    # Scanning threads are opt-in: on a local disk they are slower than
+    # scanning serially
+    scan_threads = settings.get('scan_threads') or 1
+    if scan_threads == 1:
+        scanned = _build_manifest_helper(settings['static_dir'], paths, settings['static_url_prefix'], manifest, build_cache, file_hashes)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(scan_threads) as executor:
+            scanned = _build_manifest_helper(settings['static_dir'], paths, settings['static_url_prefix'], manifest, build_cache, file_hashes, executor)
+    logging.info('Visited %d unique files for dependencies', scanned)
     assert all(make_relative_static_path(settings['static_dir'], path) in manifest.assets for path in paths)
 
     # Next, calculate the version hash for each entry in the manifest
-    for src_path in manifest.assets:
-        version_dependency(src_path, manifest)
+    version_dependencies(manifest, build_cache, file_hashes)
+
+    if build_cache is not None:
+        build_cache.save()
 
     # Normalize and validate the manifest
     manifest.normalize()
@@ -354,8 +634,190 @@ def build_manifest(tornado_paths, settings):
         
     return manifest, compilers
 
+# Compiled asset blocks are named after their content hash
+compiled_asset_matcher = re.compile(r'^[0-9a-f]+\.\w+$').match
+
+def iter_source_files(d):
+    """Walks the given directory, following symlinks, yielding the path to
+    each file found. Directories reached more than once (eg through a
+    symlink cycle) are only walked the first time.
+    """
+    seen = set()
+    for root, dirs, files in os.walk(d, followlinks=True):
+        real_root = os.path.realpath(root)
+        if real_root in seen:
+            dirs[:] = []
+            continue
+        seen.add(real_root)
+        dirs.sort()
+        for f in sorted(files):
+            yield os.path.join(root, f)
+
+def stat_source(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+def get_dir_stats(settings):
+    """Returns a dict mapping the absolute path of every file under the
+    template dirs and static_dir to its size and mtime.
+    """
+    dir_stats = {}
+    for d in list(settings['tornado_template_dirs']) + [settings['static_dir']]:
+        for path in iter_source_files(d):
+            dir_stats[os.path.abspath(path)] = stat_source(path)
+    return dir_stats
+
+def get_source_stats(settings, dir_stats, manifest, known_stats=None):
+    """Returns the given dir_stats (see `get_dir_stats`) extended with the
+    size and mtime (or None, if missing) of every asset recorded in the
+    given manifest, wherever it was found. This catches inputs outside of
+    the template dirs and static_dir, eg "../" references.
+
+    Assets in known_stats are not stat'ed again, so the stats taken at the
+    start of a build can be reused for the manifest it produced.
+    """
+    known_stats = known_stats or {}
+    source_stats = dict(dir_stats)
+    for rel_path in manifest.assets:
+        path = os.path.abspath(make_absolute_static_path(settings['static_dir'], rel_path))
+        if path in source_stats:
+            continue
+        source_stats[path] = known_stats[path] if path in known_stats else stat_source(path)
+    return source_stats
+
+def get_source_fingerprint(settings, source_stats):
+    """Returns a hash of the inputs to a build that can be checked without
+    reading any files: the stat info in the given source_stats (see
+    `get_source_stats`), and the relevant settings.
+    """
+    h = hashlib.md5()
+    for key in ('static_dir', 'static_url_prefix', 'template_extension', 'compiled_asset_root', 'hash_algorithm', 'hash_digest_size'):
+        h.update(('%s=%s\n' % (key, settings.get(key))).encode())
+    for path in sorted(source_stats):
+        h.update(('%s %r\n' % (path, source_stats[path])).encode())
+    return h.hexdigest()
+
+def get_fingerprint(settings, source_fingerprint):
+    """Combines the given source fingerprint with the state of the build
+    outputs: the stat info of the current manifest and the names of the
+    compiled assets on disk.
+    """
+    h = hashlib.md5(source_fingerprint.encode())
+    manifest_path = Manifest(settings).get_path()
+    if os.path.exists(manifest_path):
+        st = os.stat(manifest_path)
+        h.update(('%s %d %d %d\n' % (manifest_path, st.st_ino, st.st_size, st.st_mtime_ns)).encode())
+    if os.path.isdir(settings['compiled_asset_root']):
+        for f in sorted(filter(compiled_asset_matcher, os.listdir(settings['compiled_asset_root']))):
+            h.update(('%s\n' % f).encode())
+    return h.hexdigest()
+
+def get_fingerprint_path(settings):
+    return os.path.join(settings['compiled_asset_root'], 'compile_fingerprint')
+
+def read_fingerprint(settings):
+    """Returns the fingerprint recorded by the last successful build, or
+    None.
+    """
+    try:
+        with open(get_fingerprint_path(settings)) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+def write_fingerprint(settings, fingerprint):
+    if os.path.isdir(settings['compiled_asset_root']):
+        with atomic_write(get_fingerprint_path(settings)) as f:
+            f.write(fingerprint)
+
+def prune_disk_caches(settings):
+    """Removes the entries of each compiler's DiskCache that have not been
+    used for cache_max_age days, so the caches only hold what recent builds
+    needed.
+    """
+    max_age = DEFAULT_MAX_AGE
+    if settings.get('cache_max_age') is not None:
+        max_age = settings['cache_max_age'] * 24 * 60 * 60
+    for name in CSSCompiler.disk_caches:
+        DiskCache.from_settings(settings, name).prune(max_age)
+
+def get_build_cache(settings):
+    """Returns the BuildCache to use for this build, or None if disabled."""
+    if settings.get('skip_build_cache'):
+        return None
+    build_cache = BuildCache(settings)
+    if not settings.get('rebuild_build_cache'):
+        build_cache.load()
+    return build_cache
+
+def validate_build_cache(settings):
+    """Re-hashes every fresh entry in the build cache, returning a list of
+    paths whose cached hashes were wrong. The cache is re-saved without the
+    bad and stale entries.
+    """
+    build_cache = BuildCache(settings).load()
+    invalid = build_cache.validate(functools.partial(get_file_hash, settings=settings))
+    logging.info('Validated build cache: %d entries ok, %d invalid', len(build_cache), len(invalid))
+    build_cache.save()
+    return invalid
+
+def batch_js_compilers(compilers, batch_size):
+    """Groups any JSCompilers in the given list into batches of up to
+    batch_size blocks that can be compiled in one closure compiler run,
+    returning a new list of work items for CompileWorker. Blocks sharing a
+    source file can't be compiled in the same run, so they are put in
+    separate batches. Other compilers are returned as is.
+    """
+    items = []
+    batches = []
+    for compiler in compilers:
+        if not isinstance(compiler, JSCompiler):
+            items.append(compiler)
+            continue
+        paths = set(compiler.get_paths())
+        for batch, batch_paths in batches:
+            if len(batch) < batch_size and not (paths & batch_paths):
+                batch.append(compiler)
+                batch_paths.update(paths)
+                break
+        else:
+            batches.append(([compiler], paths))
+    for batch, _ in batches:
+        items.append(batch if len(batch) > 1 else batch[0])
+    return items
+
+def log_compile_summary(results, elapsed, workers):
+    """Logs how long compiling took, given the CompileResults returned by
+    CompileWorker. The longest block is the critical path: no number of
+    workers could finish the build sooner.
+    """
+    if not results:
+        return
+    total = sum(result.duration for result in results)
+    results = sorted(results, key=lambda result: result.duration, reverse=True)
+    longest = results[0]
+    logging.info('Compiled %d blocks in %.1fs (%.1fs of work on %d workers, best possible %.1fs)',
+                 len(results), elapsed, total, workers, max(longest.duration, total / workers))
+    logging.info('Critical path: %s (%.1fs)', longest.name, longest.duration)
+    for result in results[1:5]:
+        logging.info('  then %s (%.1fs)', result.name, result.duration)
+
+def parse_tool_proc_limits(specs):
+    """Parses a list of TOOL=N strings into a dict of tool limits."""
+    limits = {}
+    for spec in specs:
+        tool, _, limit = spec.partition('=')
+        try:
+            limits[tool] = int(limit)
+        except ValueError:
+            parser.error('invalid tool process limit %r, expected TOOL=N' % spec)
+    return limits
+
 def _create_settings(options):
-    return Settings(compiled_asset_root=options.output_dir,
+    settings = Settings(compiled_asset_root=options.output_dir,
                     static_dir=options.static_dir,
                     static_url_prefix=options.static_url_path,
                     tornado_template_dirs=options.tornado_template_dirs,
@@ -365,16 +827,44 @@ def _create_settings(options):
                     force_s3_upload=False,
                     force_recompile=options.force_recompile,
                     skip_inline_images=options.skip_inline_images,
+                    keep_going=options.keep_going,
+                    jobs=options.jobs,
+                    scan_threads=options.scan_threads,
+                    closure_nailgun_jar=options.closure_nailgun_jar,
+                    nailgun_client=options.nailgun_client,
+                    closure_batch_size=options.closure_batch_size,
+                    closure_chunk_flag=options.closure_chunk_flag,
+                    lessc_threads=options.lessc_threads,
+                    max_tool_procs=options.max_tool_procs,
+                    tool_proc_limits=parse_tool_proc_limits(options.tool_proc_limit),
+                    hash_algorithm=options.hash_algorithm,
+                    hash_digest_size=options.hash_digest_size,
+                    skip_build_cache=options.skip_build_cache,
+                    rebuild_build_cache=options.rebuild_build_cache,
+                    skip_minify_cache=options.skip_minify_cache,
+                    cache_dir=options.cache_dir,
+                    cache_max_age=options.cache_max_age,
+                    manifest_indent=None if options.compact_manifest else 2,
                     aws_username=options.aws_username,
                     aws_access_key=options.aws_access_key,
                     aws_secret_key=options.aws_secret_key,
                     verbose=False,
                     s3_assets_bucket=options.s3_assets_bucket)
+    try:
+        check_hash_algorithm(settings)
+    except ValueError as e:
+        parser.error(str(e))
+    return settings
 
 def run(settings):
     if not re.match(r'^/.*?/$', settings.get('static_url_prefix')):
         raise Exception('static_url_prefix setting must begin and end with a slash')
 
+    try:
+        check_hash_algorithm(settings)
+    except ValueError as e:
+        raise Exception(str(e))
+
     if not os.path.isdir(settings['compiled_asset_root']) and not settings['test_needs_compile']:
         logging.info('Creating output directory: %s', settings['compiled_asset_root'])
         os.makedirs(settings['compiled_asset_root'])
@@ -386,26 +876,52 @@ def run(settings):
     if not os.path.isdir(settings['static_dir']):
         raise Exception('Static directory not found: %r', settings['static_dir'])
 
+    # Load the current manifest
+    cached_manifest = Manifest(settings).load()
+
+    # If we're only checking whether a compile is needed and nothing has
+    # changed since the last successful build, we're done. The stats are
+    # taken before anything is read, so changes made during the build are
+    # caught next time.
+    dir_stats = get_dir_stats(settings)
+    source_stats = get_source_stats(settings, dir_stats, cached_manifest)
+    if settings['test_needs_compile'] and not settings['force_recompile']:
+        if get_fingerprint(settings, get_source_fingerprint(settings, source_stats)) == read_fingerprint(settings):
+            logging.info('Fingerprint unchanged since last build, no compile needed')
+            return cached_manifest
+
     # Find all the templates we need to parse
     tornado_paths = list(iter_template_paths(settings['tornado_template_dirs'], settings['template_extension']))
 
     if not tornado_paths:
         logging.warning("No templates found")
 
-    # Load the current manifest and generate a new one
-    cached_manifest = Manifest(settings).load()
+    # Generate a new manifest
+    if cached_manifest.hash_algorithm != get_hash_algorithm(settings):
+        # None of the cached versions can be reused, so start from scratch
+        # (but keep the generation increasing)
+        logging.warning('Hash algorithm changed from %s to %s, rebuilding everything',
+                        cached_manifest.hash_algorithm, get_hash_algorithm(settings))
+        generation = cached_manifest.generation
+        cached_manifest = Manifest(settings)
+        cached_manifest.hash_algorithm = get_hash_algorithm(settings)
+        cached_manifest.generation = generation
     try:
         current_manifest, compilers = build_manifest(tornado_paths, settings)
     except ParseError as e:
         src_path, msg = e.args
         logging.error('Error parsing template %s', src_path)
         logging.error(msg)
+        if hasattr(e, 'traceback'):
+            logging.error(e.traceback)
         raise Exception
     except DependencyError as e:
-        src_path, missing_deps = e.args
+        src_path, msg = e.args
         logging.error('Dependency error in source %s!', src_path)
-        logging.error('Missing paths: %s', missing_deps)
-        raise Exception("dependency error in %s. missing %s" % (src_path, missing_deps))
+        logging.error(msg)
+        if hasattr(e, 'traceback'):
+            logging.error(e.traceback)
+        raise Exception("dependency error in %s: %s" % (src_path, msg))
 
     # Remove duplicates from our list of compilers. This de-duplication must
     # happen after the current manifest is built, because each non-unique
@@ -416,9 +932,11 @@ def run(settings):
     logging.debug('%d unique assetman block compilers', len(compilers))
 
     # update the manifest on each our compilers to reflect the new manifest,
-    # which is needed to know the output path for each compiler.
+    # which is needed to know the output path for each compiler. Each only
+    # gets the entries it needs, because compilers are pickled into every
+    # compile task and the whole manifest can be very large.
     for compiler in compilers:
-        compiler.manifest = current_manifest
+        compiler.manifest = compiler.get_manifest_subset(current_manifest)
 
     # Figure out which asset blocks need to be (re)compiled, if any.
     def needs_compile(compiler):
@@ -434,17 +952,73 @@ def run(settings):
         if settings['test_needs_compile']:
             raise NeedsCompilation()
 
-        pool = multiprocessing.Pool()
+        # Share one closure compiler JVM between all of the JS blocks, if
+        # configured and there are any
+        closure_server = None
+        if ClosureServer.is_enabled(settings) and any(isinstance(c, JSCompiler) for c in to_compile):
+            closure_server = ClosureServer(settings)
+            if not closure_server.start():
+                closure_server = None
+
+        compile_stats = CompileStats(settings).load()
+
+        # Bound the number of tool processes run by all of the workers
+        jobserver = JobServer.from_settings(settings)
+        pool = multiprocessing.Pool(settings.get('jobs'), initializer=set_jobserver, initargs=(jobserver,))
         try:
             # See note above about bug in pool.map w/r/t KeyboardInterrupt.
-            _compile_worker = CompileWorker(settings.get('skip_inline_images', False), current_manifest)
-            pool.map_async(_compile_worker, to_compile).get(1e9) # previously set to 1e100 which caused overflow of C _PyTime_t_
+            closure_command = closure_server.get_command() if closure_server else None
+            work = to_compile
+            if (settings.get('closure_batch_size') or 1) > 1:
+                work = batch_js_compilers(to_compile, settings['closure_batch_size'])
+            lessc_threads = get_lessc_threads(settings, len(work))
+            _compile_worker = CompileWorker(settings.get('skip_inline_images', False), closure_command, lessc_threads,
+                                            keep_going=settings.get('keep_going', False))
+            # Start the blocks that took longest last time first, and hand
+            # them out one at a time, so that no worker is left with a long
+            # block at the end of the build
+            work = compile_stats.schedule(work)
+            start = time.time()
+            results = pool.imap_unordered(_compile_worker, work, chunksize=1)
+            compile_results = []
+            for _ in work:
+                compile_results.extend(results.next(1e9)) # previously set to 1e100 which caused overflow of C _PyTime_t_
+            log_compile_summary(compile_results, time.time() - start, settings.get('jobs') or multiprocessing.cpu_count())
+            for result in compile_results:
+                if not result.error:
+                    compile_stats.record(result.name_hash, result.duration)
+            compile_stats.save()
         except CompileError as e:
             cmd, msg = e.args
             logging.error('Compile error!')
             logging.error('Command: %s', ' '.join(cmd))
             logging.error('Error:   %s', msg)
             raise Exception('Compilation Failed')
+        finally:
+            if closure_server:
+                closure_server.stop()
+            if jobserver:
+                logging.info('Tool jobs: %(jobs)d run, %(waits)d waited for a token, '
+                             '%(wait_time).1fs total wait, %(max_wait).1fs longest wait', jobserver.get_stats())
+
+        prune_disk_caches(settings)
+
+        # With keep_going, record every block that did compile, so the next
+        # run only has to retry the failures
+        failures = [result for result in compile_results if result.error]
+        if failures:
+            for result in failures:
+                cmd, msg = result.error
+                logging.error('Compile error in %s!', result.name)
+                if cmd:
+                    logging.error('Command: %s', ' '.join(cmd))
+                logging.error('Error:   %s', msg)
+                # Leave the failed block's previous entry (and compiled file)
+                # in place, if it has one
+                if result.name_hash in cached_manifest.blocks:
+                    current_manifest.blocks[result.name_hash] = cached_manifest.blocks[result.name_hash]
+                else:
+                    del current_manifest.blocks[result.name_hash]
 
         #TODO: refactor to some chain of command for plugins
         if settings['aws_username']:
@@ -454,13 +1028,29 @@ def run(settings):
         if settings.get('merge_manifest_updates', True):
             cached_manifest.union(current_manifest)
         else:
+            # Keep the generation increasing across replaced manifests
+            current_manifest.generation = cached_manifest.generation
             cached_manifest = current_manifest
-        cached_manifest.write(settings=settings)
+        cached_manifest.write(settings=settings, indent=settings.get('manifest_indent', 2))
+        # The runtime manifests are written last, so they are never older
+        # than the manifest.json they were built from (see
+        # load_runtime_manifest).
+        RuntimeManifest.write(cached_manifest, settings['compiled_asset_root'])
+        ManifestIndex.write(cached_manifest, settings['compiled_asset_root'])
+        Manifest.invalidate_shared(settings['compiled_asset_root'])
+        if failures:
+            raise Exception('Compilation Failed: %d of %d blocks failed' % (len(failures), len(compile_results)))
+        # Also fingerprint any inputs first found by this build
+        source_stats = get_source_stats(settings, dir_stats, cached_manifest, source_stats)
+        write_fingerprint(settings, get_fingerprint(settings, get_source_fingerprint(settings, source_stats)))
         return cached_manifest
+    write_fingerprint(settings, get_fingerprint(settings, get_source_fingerprint(settings, source_stats)))
     return current_manifest
 
 if __name__ == '__main__':
     logging.getLogger().setLevel(logging.DEBUG)
     options, args = parser.parse_args()
     settings = _create_settings(options) 
+    if options.validate_build_cache:
+        sys.exit(1 if validate_build_cache(settings) else 0)
     run(settings)
@@ -0,0 +1,57 @@
+import os
+import json
+import logging
+
+from assetman.tools import atomic_write
+
+
+class CompileStats(object):
+    """A sidecar file next to the manifest recording how long each asset
+    block took to compile the last time it was compiled, keyed on the
+    block's name hash. It is used to schedule the longest blocks first, so
+    that a huge block doesn't start last and become the tail of the build.
+    """
+
+    def __init__(self, settings, path=None):
+        self.settings = settings
+        self.path = path or self.get_path(settings['compiled_asset_root'])
+        self.durations = {}
+
+    @classmethod
+    def get_path(cls, compiled_asset_root):
+        return os.path.join(compiled_asset_root, 'compile_stats.json')
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.durations = json.load(f)
+            assert isinstance(self.durations, dict)
+        except (AssertionError, IOError, ValueError) as e:
+            logging.info('Not using compile stats %s: %s', self.path, e)
+            self.durations = {}
+        return self
+
+    def save(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            return
+        with atomic_write(self.path) as f:
+            json.dump(self.durations, f, separators=(',', ':'))
+
+    def record(self, name_hash, duration):
+        self.durations[name_hash] = duration
+
+    def estimate(self, compilers):
+        """Returns the expected time to compile the given compiler (or list
+        of compilers, compiled together). Blocks without any history are
+        assumed to take the average time of those with history.
+        """
+        if not isinstance(compilers, list):
+            compilers = [compilers]
+        default = sum(self.durations.values()) / len(self.durations) if self.durations else 0
+        return sum(self.durations.get(c.get_hash(), default) for c in compilers)
+
+    def schedule(self, work):
+        """Returns the given work items (compilers or lists of compilers)
+        ordered longest first.
+        """
+        return sorted(work, key=self.estimate, reverse=True)
@@ -1,38 +1,81 @@
 
 
 import base64
-from collections import defaultdict
-import hashlib
+from collections import defaultdict, OrderedDict
 import logging
 import mimetypes
+import stat
 import subprocess
+import tempfile
+import shutil
 import functools
+import threading
+import multiprocessing
+import concurrent.futures
 import os
 import re
 
 import assetman.managers
-from assetman.tools import make_absolute_static_path, make_relative_static_path, get_static_pattern, make_output_path, _unicode
+import assetman.jobserver
+from assetman.disk_cache import DiskCache
+from assetman.tools import make_absolute_static_path, make_relative_static_path, get_static_pattern, make_output_path, _unicode, new_hash, atomic_write
 
-def run_proc(cmd, stdin=None):
+def run_proc(cmd, stdin=None, stdout=None):
     """Runs the given cmd as a subprocess. If the exit code is non-zero, calls
     sys.exit with the exit code (aborting program). If stdin is given, it will
     be piped to the subprocess's stdin.
 
+    The subprocess's output is returned as a string, unless stdout is given,
+    in which case it must be a binary file which the output is written
+    straight into (and None is returned).
+
     The cmd should be a command suitable for passing to subprocess.call (ie, a
     list, usually).
+
+    If this process has a JobServer (see `assetman.jobserver`), the command
+    only runs once it holds the job tokens it needs.
     """
     popen_args = dict(stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     if stdin is not None:
         popen_args['stdin'] = subprocess.PIPE
         stdin = stdin.encode()
-    proc = subprocess.Popen(cmd, **popen_args)
-    out, err = proc.communicate(input=stdin)
+    if stdout is not None:
+        # Anything we've buffered must land before the subprocess's output
+        stdout.flush()
+        popen_args['stdout'] = stdout
+    with assetman.jobserver.job(cmd):
+        proc = subprocess.Popen(cmd, **popen_args)
+        out, err = proc.communicate(input=stdin)
     if proc.returncode != 0:
         raise CompileError(cmd, err)
     elif err:
         logging.warning('%s stderr:\n%s', cmd[0], err)
+    if stdout is not None:
+        # The subprocess moved the shared file offset behind our back
+        stdout.seek(0, os.SEEK_END)
+        return None
     return out.decode()
 
+def get_tool_version(path):
+    """Returns a string identifying the build of the tool binary at path,
+    based on its size and modification time, for use in cache keys.
+    """
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    return '%s:%d:%d' % (path, st.st_size, st.st_mtime_ns)
+
+def get_lessc_threads(settings, concurrent_blocks=None):
+    """Returns how many lessc processes a single Less block may run at once:
+    the lessc_threads setting if given, or else the block's share of the CPUs
+    when the compile pool (sized by the jobs setting) is working on
+    concurrent_blocks blocks at once, so the machine isn't oversubscribed.
+    """
+    if settings.get('lessc_threads'):
+        return settings['lessc_threads']
+    cpus = multiprocessing.cpu_count()
+    blocks = min(settings.get('jobs') or cpus, concurrent_blocks or cpus)
+    return max(1, cpus // max(1, blocks))
+
 class CompileError(Exception):
     """Error encountered while compiling assets."""
 
@@ -74,6 +117,22 @@ class AssetCompiler(object):
         result =  self.do_compile(**kwargs)
         return result
 
+    def compile_to_file(self, path, **kwargs):
+        """Compiles the assets in this Assetman block into the file at path.
+        The compiler's output is streamed into a temporary file next to path,
+        which is only renamed into place once it is complete, so an
+        interrupted or failed compile never leaves a partial file behind.
+
+        Subclasses' do_compile methods are given the temporary file as the
+        outfile kwarg, and may either write their output to it and return
+        None or return their output as a string.
+        """
+        logging.info("Compiling %s", self)
+        with atomic_write(path, 'wb') as outfile:
+            result = self.do_compile(outfile=outfile, **kwargs)
+            if result is not None:
+                outfile.write(result.encode())
+
     def do_compile(self, **kwargs):
         raise NotImplementedError
 
@@ -105,8 +164,8 @@ class AssetCompiler(object):
         return True
 
     def get_current_content_hash(self, manifest):
-        """Gets the md5 hash for each of the files in this manager's list of assets."""
-        h = hashlib.md5()
+        """Gets the content hash for each of the files in this manager's list of assets."""
+        h = new_hash(self.settings)
         for path in self.get_paths():
             relative_path = make_relative_static_path(self.settings['static_dir'], path)
             assert relative_path in manifest.assets, relative_path
@@ -120,9 +179,27 @@ class AssetCompiler(object):
             assert all(map(os.path.isfile, paths))
         except AssertionError:
             missing = [path for path in paths if not os.path.isfile(path)]
-            raise DependencyError(self.src_path, ','.join(missing))
+            raise DependencyError(self.src_path, 'missing paths: %s' % ','.join(missing))
         return paths
 
+    def get_manifest_subset(self, manifest):
+        """Returns the part of the given manifest this compiler needs to
+        compile its block: the entry for the block itself and those for its
+        assets and their dependencies.
+        """
+        static_dir = self.settings['static_dir']
+        asset_paths = set(make_relative_static_path(static_dir, path) for path in self.get_paths())
+        # Include the assets' deps (eg, images that may be inlined), all the
+        # way down
+        to_visit = list(asset_paths)
+        while to_visit:
+            entry = manifest.assets.get(to_visit.pop())
+            for dep in (entry['deps'] if entry else ()):
+                if dep not in asset_paths:
+                    asset_paths.add(dep)
+                    to_visit.append(dep)
+        return manifest.subset([self.get_hash()], asset_paths)
+
     def get_compiled_path(self):
         """Creates the output filename for the compiled assets of the given manager."""
         return make_output_path(self.settings['compiled_asset_root'], self.get_compiled_name())
@@ -132,18 +209,80 @@ class JSCompiler(AssetCompiler, assetman.managers.JSManager):
 
     include_expr = 'include_js'
 
+    closure_args = [
+        '--compilation_level', 'SIMPLE_OPTIMIZATIONS',
+        '--language_in', 'ECMASCRIPT5',
+        ]
+
     def do_compile(self, **kwargs):
         """We just hand each of the input paths to the closure compiler and
         let it go to work.
         """
+        args = list(self.closure_args)
+        for path in self.get_paths():
+            # The server JVM doesn't share our working directory
+            args.extend(('--js', os.path.abspath(path)))
+        return self.run_closure(args, kwargs.get("closure_command"), kwargs.get("outfile"))
+
+    def run_closure(self, args, closure_command=None, outfile=None):
+        """Runs the closure compiler with the given args, writing its output to
+        outfile if given (see run_proc). If a closure_command is given (see
+        `assetman.closure_server`), the compiler is run through it instead of
+        in a fresh JVM, falling back to a fresh JVM if that fails.
+        """
+        if closure_command:
+            start = outfile.tell() if outfile is not None else None
+            try:
+                return run_proc(closure_command + args, stdout=outfile)
+            except (CompileError, OSError) as e:
+                logging.warning('Closure compiler server failed for %s, retrying in a new JVM: %s', self, e)
+                if outfile is not None:
+                    # Throw away anything the failed run wrote
+                    outfile.seek(start)
+                    outfile.truncate()
         cmd = [
             self.required_setting_file("java_bin"), '-Xss16m', '-jar', self.required_setting_file("closure_compiler"),
-            '--compilation_level', 'SIMPLE_OPTIMIZATIONS',
-            '--language_in', 'ECMASCRIPT5',
-            ]
-        for path in self.get_paths():
-            cmd.extend(('--js', path))
-        return run_proc(cmd)
+            ] + args
+        return run_proc(cmd, stdout=outfile)
+
+    @classmethod
+    def compile_batch(cls, compilers, **kwargs):
+        """Compiles several JS blocks in a single closure compiler run,
+        returning a list of their compiled sources, or copying them into the
+        binary files in the outfiles kwarg if given. Each block becomes its own
+        module (which newer versions of the closure compiler call a chunk, see
+        the `closure_chunk_flag` setting), all depending on an empty root
+        module, and each module's output is read back separately.
+
+        No source file may appear in more than one of the given blocks.
+        """
+        assert compilers
+        first = compilers[0]
+        logging.info('Compiling batch of %d JS blocks: %s', len(compilers), ', '.join(map(str, compilers)))
+        chunk_flag = first.settings.get('closure_chunk_flag') or '--module'
+        output_dir = tempfile.mkdtemp(prefix='assetman_closure_')
+        try:
+            root_path = os.path.join(output_dir, 'assetman_root.js')
+            open(root_path, 'w').close()
+            args = list(cls.closure_args) + ['--js', root_path, chunk_flag, 'assetman_root:1']
+            for i, compiler in enumerate(compilers):
+                paths = compiler.get_paths()
+                for path in paths:
+                    args.extend(('--js', os.path.abspath(path)))
+                args.extend((chunk_flag, 'block%d:%d:assetman_root' % (i, len(paths))))
+            args.extend((chunk_flag + '_output_path_prefix', output_dir + os.sep))
+            first.run_closure(args, kwargs.get("closure_command"))
+            outfiles = kwargs.get("outfiles")
+            outputs = []
+            for i in range(len(compilers)):
+                with open(os.path.join(output_dir, 'block%d.js' % i), 'rb') as f:
+                    if outfiles:
+                        shutil.copyfileobj(f, outfiles[i])
+                    else:
+                        outputs.append(f.read().decode())
+            return None if outfiles else outputs
+        finally:
+            shutil.rmtree(output_dir)
 
 
 class CSSCompiler(AssetCompiler, assetman.managers.CSSManager):
@@ -159,18 +298,79 @@ class CSSCompiler(AssetCompiler, assetman.managers.CSSManager):
 
         This also allows us to accept a css_input argument, so this function
         can be used by the compile_less function as well.
+
+        Unless the skip_minify_cache setting is set, each file is instead
+        minified on its own and the results are cached in the minify cache
+        (see get_minify_cache), which is shared by every block, so only the
+        files that changed since the last build are run through the
+        compressor.
         """
         css_input = kwargs.get("css_input")
+        outfile = kwargs.get("outfile")
         if css_input is None:
+            if not self.settings.get('skip_minify_cache'):
+                pieces = (self.minify_file(path, kwargs.get("skip_inline_images")) for path in self.get_paths())
+                if outfile is None:
+                    return '\n'.join(pieces)
+                for i, piece in enumerate(pieces):
+                    outfile.write((piece if i == 0 else '\n' + piece).encode())
+                return None
             css_input = '\n'.join(
                 open(path).read() for path in self.get_paths())
         if not kwargs.get("skip_inline_images"):
             css_input = self.inline_images(css_input)
+        return self.minify(css_input, outfile)
+
+    def minify(self, css_input, outfile=None):
         cmd = [
            self.required_setting_file("minify_compressor_path"),
            '--type=css'
         ]
-        return run_proc(cmd, stdin=css_input)
+        return run_proc(cmd, stdin=css_input, stdout=outfile)
+
+    # Names of the DiskCaches used by this compiler, which are pruned after
+    # each build
+    disk_caches = ('minify_cache', 'data_uri_cache')
+
+    def get_minify_cache(self):
+        return DiskCache.from_settings(self.settings, 'minify_cache')
+
+    def get_minify_cache_key(self, path, skip_inline_images):
+        """Returns the minify cache key for the given file, which covers its
+        manifest version (and so the versions of any images that might be
+        inlined into it), the compressor binary and the settings that affect
+        the output. Returns None if the file's version isn't known.
+        """
+        rel_path = make_relative_static_path(self.settings['static_dir'], path)
+        # Only trust a manifest explicitly given to us by the compiler, not
+        # the shared (possibly out of date) one
+        entry = self._manifest.assets.get(rel_path) if self._manifest is not None else None
+        if not entry or not entry.get('version'):
+            return None
+        key = [
+            'css', entry['version'], get_tool_version(self.required_setting_file("minify_compressor_path")),
+            self.settings.get('static_url_prefix'), bool(skip_inline_images),
+        ]
+        return new_hash(self.settings, repr(key).encode()).hexdigest()
+
+    def minify_file(self, path, skip_inline_images=False):
+        """Returns the minified CSS for a single file, from the minify cache
+        if possible.
+        """
+        key = self.get_minify_cache_key(path, skip_inline_images)
+        cache = self.get_minify_cache()
+        if key is not None:
+            output = cache.get(key)
+            if output is not None:
+                logging.debug('Minify cache hit for %s', path)
+                return output
+        css_input = open(path).read()
+        if not skip_inline_images:
+            css_input = self.inline_images(css_input)
+        output = self.minify(css_input)
+        if key is not None:
+            cache.set(key, output)
+        return output
 
     def inline_images(self, css_src):
         """Here we will "inline" any images under a certain size threshold
@@ -178,51 +378,23 @@ class CSSCompiler(AssetCompiler, assetman.managers.CSSManager):
 
         IE 8 can't handle URLs longer than 32KB, so any image whose data URI
         is larger than that is skipped.
-        """
-        KB = 1024.0
-        MAX_FILE_SIZE = 24 * KB # Largest size we consider for inlining
-        MAX_DATA_URI_SIZE = 32 * KB # IE8's maximum URL size
-
-        # We only want to replace asset references that show up inside of
-        # `url()` rules (this avoids weird constructs like IE-specific filters
-        # for transparent PNG support).
-        base_pattern = get_static_pattern(self.settings.get('static_url_prefix'))
-        pattern = r"""(url\(["']?)%s(["']?\))""" % base_pattern
 
+        Data URIs (and decisions not to inline) are cached by each image's
+        manifest version in the data URI cache (see get_data_uri_cache), which
+        is shared between blocks, workers and builds.
+        """
         # Track duplicate images so that we can warn about them
         seen_assets = defaultdict(int)
 
         def replacer(match):
             before, url_prefix, rel_path, after = match.groups()
-            path = make_absolute_static_path(self.settings['static_dir'], rel_path)
-            assert os.path.isfile(path), (path, str(self))
-            if os.stat(path).st_size > MAX_FILE_SIZE:
-                logging.debug('Not inlining %s (%.2fKB)', path, os.stat(path).st_size / KB)
+            data_uri = self.get_data_uri(rel_path)
+            if data_uri is None:
                 return match.group(0)
-            else:
-                # data_uri format requires strings instead of bytes
-                encoded = _unicode(base64.b64encode(open(path, 'rb').read()))
-                mime_type, _ = mimetypes.guess_type(path)
-                if not mime_type and path.endswith('.otf'):
-                    mime_type = 'application/octet-stream'
-                if not mime_type and path.endswith('.ttf'):
-                    mime_type = 'font/ttf'
-                if not mime_type and path.endswith('.eot'):
-                    mime_type = 'application/vnd.ms-fontobject'
-                if not mime_type and path.endswith('.woff'):
-                    mime_type = 'application/x-font-woff'
-                if not mime_type and path.endswith('.json'):
-                    mime_type = 'application/json'
-                if not mime_type and path.endswith('.svg'):
-                    mime_type = 'image/svg+xml'
-                data_uri = 'data:%s;base64,%s' % (mime_type, encoded)
-                if len(data_uri) >= MAX_DATA_URI_SIZE:
-                    logging.debug('Not inlining %s (%.2fKB encoded)', path, len(data_uri) / KB)
-                    return match.group(0)
-                seen_assets['%s%s' % (url_prefix, rel_path)] += 1
-                return ''.join([before, data_uri, after])
-
-        result = re.sub(pattern, replacer, css_src)
+            seen_assets['%s%s' % (url_prefix, rel_path)] += 1
+            return ''.join([before, data_uri, after])
+
+        result = get_inline_image_matcher(self.settings.get('static_url_prefix')).sub(replacer, css_src)
 
         for url, count in seen_assets.items():
             if count > 1:
@@ -230,6 +402,98 @@ class CSSCompiler(AssetCompiler, assetman.managers.CSSManager):
 
         return result
 
+    def get_data_uri_cache(self):
+        return DiskCache.from_settings(self.settings, 'data_uri_cache')
+
+    def get_data_uri(self, rel_path):
+        """Returns the data URI to inline for the static asset at rel_path, or
+        None if it is too large to inline. The result is cached under the
+        asset's manifest version and extension (which determines its mime
+        type), if it has a version.
+        """
+        path = make_absolute_static_path(self.settings['static_dir'], rel_path)
+        rel_path = make_relative_static_path(self.settings['static_dir'], path)
+        entry = self._manifest.assets.get(rel_path) if self._manifest is not None else None
+        if not entry or not entry.get('version'):
+            return make_data_uri(path, str(self))
+        key = [
+            'data-uri', entry['version'], os.path.splitext(rel_path)[1],
+            INLINE_MAX_FILE_SIZE, INLINE_MAX_DATA_URI_SIZE,
+        ]
+        key = new_hash(self.settings, repr(key).encode()).hexdigest()
+        data_uri = data_uri_memo.get(key, '')
+        if data_uri != '':
+            return data_uri
+        cache = self.get_data_uri_cache()
+        # An empty entry records that the asset is too large to inline
+        data_uri = cache.get(key)
+        if data_uri is None:
+            data_uri = make_data_uri(path, str(self)) or ''
+            cache.set(key, data_uri)
+        data_uri = data_uri or None
+        memoize_data_uri(key, data_uri)
+        return data_uri
+
+
+# The data URIs most recently added by this process, by cache key
+data_uri_memo = OrderedDict()
+data_uri_memo_lock = threading.Lock()
+DATA_URI_MEMO_SIZE = 512
+
+def memoize_data_uri(key, data_uri):
+    with data_uri_memo_lock:
+        data_uri_memo[key] = data_uri
+        while len(data_uri_memo) > DATA_URI_MEMO_SIZE:
+            data_uri_memo.popitem(last=False)
+
+# Largest size we consider for inlining, and IE8's maximum URL size
+INLINE_MAX_FILE_SIZE = 24 * 1024
+INLINE_MAX_DATA_URI_SIZE = 32 * 1024
+
+# Mime types that mimetypes doesn't know about
+extra_mime_types = {
+    '.otf': 'application/octet-stream',
+    '.ttf': 'font/ttf',
+    '.eot': 'application/vnd.ms-fontobject',
+    '.woff': 'application/x-font-woff',
+    '.json': 'application/json',
+    '.svg': 'image/svg+xml',
+}
+
+@functools.lru_cache()
+def get_inline_image_matcher(static_url_prefix):
+    """Returns a compiled regular expression matching references to static
+    assets under static_url_prefix inside of `url()` rules (this avoids weird
+    constructs like IE-specific filters for transparent PNG support).
+    """
+    base_pattern = get_static_pattern(static_url_prefix)
+    return re.compile(r"""(url\(["']?)%s(["']?\))""" % base_pattern)
+
+def make_data_uri(path, src=None):
+    """Returns a "data:" URI for the file at path, or None if the file or
+    its URI would be too large to inline.
+    """
+    KB = 1024.0
+    try:
+        st = os.stat(path)
+    except OSError:
+        st = None
+    assert st is not None and stat.S_ISREG(st.st_mode), (path, src)
+    if st.st_size > INLINE_MAX_FILE_SIZE:
+        logging.debug('Not inlining %s (%.2fKB)', path, st.st_size / KB)
+        return None
+    # data_uri format requires strings instead of bytes
+    with open(path, 'rb') as f:
+        encoded = _unicode(base64.b64encode(f.read()))
+    mime_type, _ = mimetypes.guess_type(path)
+    if not mime_type:
+        mime_type = extra_mime_types.get(os.path.splitext(path)[1])
+    data_uri = 'data:%s;base64,%s' % (mime_type, encoded)
+    if len(data_uri) >= INLINE_MAX_DATA_URI_SIZE:
+        logging.debug('Not inlining %s (%.2fKB encoded)', path, len(data_uri) / KB)
+        return None
+    return data_uri
+
 
 class LessCompiler(CSSCompiler, assetman.managers.LessManager):
 
@@ -242,11 +506,21 @@ class LessCompiler(CSSCompiler, assetman.managers.LessManager):
         First, we have to run each of the given paths through lessc
         separately, capturing and concatenating the output. Then, we send all
         of the compiled CSS to the YUI compressor.
+
+        The lessc runs happen concurrently, up to lessc_threads at a time (see
+        get_lessc_threads), and their outputs are concatenated in their
+        original order.
         """
         # First we "compile" the less files into CSS
         lessc = self.required_setting_file("lessc_path")
-        outputs = [run_proc([lessc, path]) for path in self.get_paths()]
-        return super(LessCompiler, self).do_compile(css_input='\n'.join(outputs))
+        paths = self.get_paths()
+        threads = min(kwargs.get("lessc_threads") or get_lessc_threads(self.settings), len(paths))
+        if threads > 1:
+            with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+                outputs = list(executor.map(lambda path: run_proc([lessc, path]), paths))
+        else:
+            outputs = [run_proc([lessc, path]) for path in paths]
+        return super(LessCompiler, self).do_compile(css_input='\n'.join(outputs), outfile=kwargs.get("outfile"))
 
 
 class SassCompiler(CSSCompiler, assetman.managers.SassManager):
@@ -259,5 +533,5 @@ class SassCompiler(CSSCompiler, assetman.managers.SassManager):
             '--compass', '--trace', '--no-cache', '--stop-on-error', '-l'
         ] + self.rel_urls
         output = run_proc(cmd)
-        return super(SassCompiler, self).do_compile(css_input=output)
+        return super(SassCompiler, self).do_compile(css_input=output, outfile=kwargs.get("outfile"))
 
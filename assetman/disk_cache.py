@@ -0,0 +1,79 @@
+import os
+import time
+import logging
+
+from assetman.tools import atomic_write
+
+# Entries not used for this long are removed by `DiskCache.prune`
+DEFAULT_MAX_AGE = 7 * 24 * 60 * 60
+
+
+class DiskCache(object):
+    """A content-addressed cache of strings on disk, which may be shared by
+    any number of processes. Each value is stored in its own file, named
+    after its key (which should be a hex digest of everything that went into
+    producing the value) and written atomically, so readers never see a
+    partial entry and concurrent writers of the same key are harmless.
+
+    Reading an entry bumps its mtime, so entries that have stopped being
+    used can be found and removed by `prune`.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def __str__(self):
+        return '<DiskCache %s>' % self.root
+
+    @classmethod
+    def from_settings(cls, settings, name):
+        """Returns the named cache in the cache_dir setting, which defaults to
+        compiled_asset_root.
+        """
+        return cls(os.path.join(settings.get('cache_dir') or settings['compiled_asset_root'], name))
+
+    def get_path(self, key):
+        # Spread entries across subdirectories to keep directories small
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """Returns the value stored under key, or None."""
+        path = self.get_path(key)
+        try:
+            with open(path) as f:
+                value = f.read()
+        except IOError:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def set(self, key, value):
+        path = self.get_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with atomic_write(path) as f:
+                f.write(value)
+        except (IOError, OSError) as e:
+            logging.warning('Could not write %s to %s: %s', key, self, e)
+
+    def prune(self, max_age=DEFAULT_MAX_AGE):
+        """Removes every entry that has not been written or read in the last
+        max_age seconds, returning the number removed.
+        """
+        cutoff = time.time() - max_age
+        removed = 0
+        for root, dirs, files in os.walk(self.root):
+            for f in files:
+                path = os.path.join(root, f)
+                try:
+                    if os.stat(path).st_mtime < cutoff:
+                        os.unlink(path)
+                        removed += 1
+                except OSError:
+                    pass
+        if removed:
+            logging.info('Pruned %d unused entries from %s', removed, self)
+        return removed
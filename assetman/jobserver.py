@@ -0,0 +1,109 @@
+import os
+import time
+import logging
+import contextlib
+import multiprocessing
+
+
+class JobServer(object):
+    """Limits how many external tool processes (JVMs, lessc, minify, etc)
+    run at once across every compile worker process, in the spirit of make's
+    jobserver. Each tool run must hold a token from the global pool (if
+    there is a global limit) and from its tool's pool (if that tool has its
+    own limit), so that memory-heavy tools like the JVM can be held to fewer
+    concurrent processes than cheap ones.
+
+    Tools are identified by the basename of their executable, eg 'java' or
+    'lessc'. The tokens are multiprocessing semaphores, so a JobServer must
+    be created before the worker processes that share it, and passed to
+    them when they start (see `set_jobserver`).
+
+    The time spent waiting for tokens is recorded for `get_stats`.
+    """
+
+    def __init__(self, limit=None, tool_limits=None):
+        self.limit = limit
+        self.tool_limits = dict(tool_limits or {})
+        self._tokens = multiprocessing.BoundedSemaphore(limit) if limit else None
+        self._tool_tokens = dict(
+            (tool, multiprocessing.BoundedSemaphore(n)) for tool, n in self.tool_limits.items())
+        self._jobs = multiprocessing.Value('i', 0)
+        self._waits = multiprocessing.Value('i', 0)
+        self._wait_time = multiprocessing.Value('d', 0.0)
+        self._max_wait = multiprocessing.Value('d', 0.0)
+
+    def __str__(self):
+        return '<JobServer limit:%s tool_limits:%s>' % (self.limit, self.tool_limits)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Returns a JobServer for the max_tool_procs and tool_proc_limits
+        settings, or None if neither is set.
+        """
+        limit = settings.get('max_tool_procs')
+        tool_limits = settings.get('tool_proc_limits')
+        if not (limit or tool_limits):
+            return None
+        return cls(limit, tool_limits)
+
+    @contextlib.contextmanager
+    def job(self, cmd):
+        """Holds the tokens needed to run the given command for the duration
+        of the with block.
+        """
+        tool = os.path.basename(cmd[0])
+        # Always take the tool's token before the global one, so a process
+        # never holds a global token while waiting on its tool's limit
+        semaphores = [s for s in (self._tool_tokens.get(tool), self._tokens) if s is not None]
+        start = time.time()
+        for semaphore in semaphores:
+            semaphore.acquire()
+        try:
+            self._record(tool, time.time() - start)
+            yield
+        finally:
+            for semaphore in reversed(semaphores):
+                semaphore.release()
+
+    def _record(self, tool, wait):
+        with self._jobs.get_lock():
+            self._jobs.value += 1
+        # Don't count the cost of acquiring a free token as waiting
+        if wait < 0.001:
+            return
+        logging.debug('Waited %.3fs to run %s', wait, tool)
+        with self._wait_time.get_lock():
+            self._waits.value += 1
+            self._wait_time.value += wait
+            self._max_wait.value = max(self._max_wait.value, wait)
+
+    def get_stats(self):
+        """Returns a dict of the number of jobs run, how many of them had to
+        wait for a token, and the total and maximum wait in seconds.
+        """
+        with self._wait_time.get_lock():
+            return {
+                'jobs': self._jobs.value,
+                'waits': self._waits.value,
+                'wait_time': self._wait_time.value,
+                'max_wait': self._max_wait.value,
+            }
+
+
+# The JobServer used by `assetman.compilers.run_proc` in this process, if any
+jobserver = None
+
+def set_jobserver(server):
+    """Sets the JobServer used by this process. Also suitable for use as a
+    multiprocessing.Pool initializer, to share a JobServer with workers.
+    """
+    global jobserver
+    jobserver = server
+
+def job(cmd):
+    """Returns a context manager that holds this process's JobServer tokens
+    for running cmd, if there is a JobServer.
+    """
+    if jobserver is None:
+        return contextlib.nullcontext()
+    return jobserver.job(cmd)
@@ -4,10 +4,66 @@ import os
 import logging
 import functools
 import hashlib
+import threading
+import collections
 
 from assetman.tools import get_shard_from_list, _unicode
 from assetman.manifest import Manifest
 
+
+class RenderCache(object):
+    """A bounded, thread-safe LRU cache of rendered asset blocks. Keys are
+    built by `AssetManager.get_render_cache_key` and include the load_id of
+    the shared manifest, so entries for an outdated manifest simply stop being
+    hit and age out.
+
+    The hits and misses counters can be inspected (e.g., via `stats()`) to
+    confirm the cache is effective in production.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'max_size': self.max_size,
+        }
+
+
+# Process-wide cache of rendered asset blocks
+render_cache = RenderCache()
+
+
 class AssetManager(object):
     """AssetManager attempts to provide easy-to-use asset management and
     compilation for Tornado (or other?) templates.
@@ -56,11 +112,12 @@ class AssetManager(object):
         self.settings = settings
         logging.debug('%s URLs: %r', self.__class__.__name__, self.rel_urls)
 
-    # Lazy-load the manifest attribute
+    # Unless one was explicitly set, the manifest comes from the process-wide
+    # manifest cache, so long-lived managers see invalidations too.
     def get_manifest(self):
-        if not self._manifest:
-            self._manifest = Manifest(self.settings).load()
-        return self._manifest
+        if self._manifest is not None:
+            return self._manifest
+        return Manifest.shared(self.settings)
 
     def set_manifest(self, manifest):
         self._manifest = manifest
@@ -70,6 +127,10 @@ class AssetManager(object):
     def get_hash(self):
         """Gets the md5 hash for the URLs in this block of assets, which will
         be used to refer to the compiled assets in production.
+
+        This is a lookup key rather than a content version, so it does not
+        follow the `hash_algorithm` setting: the app's runtime settings need
+        not agree with the compiler's for blocks to be found.
         """
         return hashlib.md5('\n'.join(self.rel_urls).encode()).hexdigest()
 
@@ -84,7 +145,7 @@ class AssetManager(object):
         which is composed of its version hash and a filed extension.
         """
         name_hash = self.get_hash()
-        return self.manifest.blocks[name_hash]['versioned_path']
+        return self.manifest.get_block_path(name_hash)
 
     def make_asset_url(self, rel_url):
         """Builds a full URL based the given relative URL."""
@@ -116,7 +177,55 @@ class AssetManager(object):
     def render_asset_element(self, url):
         raise NotImplementedError
 
+    def get_render_cache_key(self):
+        """Returns the key under which this block's rendered output is stored
+        in the render cache, or None if the output should not be cached (ie,
+        when a manifest has been explicitly set on this manager or the attrs
+        are unhashable).
+        """
+        if self._manifest is not None:
+            return None
+        settings = self.settings
+        if settings['enable_static_compilation']:
+            load_id = None
+        else:
+            load_id = self.manifest.load_id
+        cdn_url_prefix = settings.get('cdn_url_prefix')
+        if isinstance(cdn_url_prefix, list):
+            cdn_url_prefix = tuple(cdn_url_prefix)
+        key = (
+            self.__class__,
+            tuple(self.rel_urls),
+            self.local,
+            self.include_tag,
+            tuple(sorted(self.attrs.items())),
+            load_id,
+            settings.get('compiled_asset_root'),
+            settings['enable_static_compilation'],
+            settings.get('static_url_prefix'),
+            settings.get('local_cdn_url_prefix'),
+            cdn_url_prefix,
+        )
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
     def render(self):
+        """Renders these assets, reusing previously rendered output for an
+        identical block when possible. See `render_uncached`.
+        """
+        key = self.get_render_cache_key()
+        if key is None:
+            return self.render_uncached()
+        rendered = render_cache.get(key)
+        if rendered is None:
+            rendered = self.render_uncached()
+            render_cache.set(key, rendered)
+        return rendered
+
+    def render_uncached(self):
         """Renders these assets. If static compilation is enabled, each asset is
         rendered individually. In a production environment, this should be disabled and
         just the compiled asset should rendered.
@@ -161,8 +270,8 @@ class AssetManager(object):
         if self.settings['enable_static_compilation']:
             return self.make_asset_url(url_path)
         else:
-            assert url_path in self.manifest.assets, url_path
-            versioned_path = self.manifest.assets[url_path]['versioned_path']
+            assert self.manifest.has_asset(url_path), url_path
+            versioned_path = self.manifest.get_asset_path(url_path)
             return self.make_asset_url(versioned_path)
 
     def __str__(self):
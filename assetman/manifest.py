@@ -3,8 +3,13 @@
 import os
 import json
 import logging
+import struct
+import itertools
+import threading
 
 from assetman.settings import Settings
+from assetman.manifest_index import ManifestIndex
+from assetman.tools import atomic_write
 
 class Manifest(object):
     """
@@ -15,6 +20,11 @@ class Manifest(object):
 
     _manifest = None
 
+    # Assigned by the shared manifest registry every time a manifest is
+    # (re)loaded, so that caches derived from a manifest can tell when it has
+    # changed.
+    load_id = 0
+
     def __init__(self, settings=None):
         self.settings = settings or Settings()
         self._manifest = self.make_empty_manifest()
@@ -22,6 +32,29 @@ class Manifest(object):
     def data(self):
         return self._manifest
 
+    @property
+    def generation(self):
+        """The number of times this manifest has been written, which is
+        incremented by each call to `write`.
+        """
+        return self._manifest.get('generation', 0)
+
+    @generation.setter
+    def generation(self, generation):
+        self._manifest['generation'] = generation
+
+    @property
+    def hash_algorithm(self):
+        """The content hash algorithm this manifest's versions were computed
+        with, as returned by `assetman.tools.get_hash_algorithm`. Manifests
+        that don't record one were built with md5.
+        """
+        return self._manifest.get('hash_algorithm', 'md5')
+
+    @hash_algorithm.setter
+    def hash_algorithm(self, hash_algorithm):
+        self._manifest['hash_algorithm'] = hash_algorithm
+
     @property
     def assets(self):
         return self._manifest['assets']
@@ -29,6 +62,33 @@ class Manifest(object):
     def blocks(self):
         return self._manifest['blocks']
     
+    def get_block_path(self, name_hash):
+        """Returns the versioned path of the compiled asset block identified
+        by name_hash. Raises KeyError if there is no such block.
+        """
+        return self.blocks[name_hash]['versioned_path']
+
+    def get_asset_path(self, path):
+        """Returns the versioned path of the static asset at the given path
+        (relative to static_dir). Raises KeyError if there is no such asset.
+        """
+        return self.assets[path]['versioned_path']
+
+    def has_asset(self, path):
+        return path in self.assets
+
+    def is_empty(self):
+        return not (self.blocks or self.assets)
+
+    def subset(self, block_hashes=(), asset_paths=()):
+        """Returns a new manifest containing only the given blocks and
+        assets (any that aren't in this manifest are skipped).
+        """
+        manifest = Manifest(self.settings)
+        manifest.blocks.update((k, self.blocks[k]) for k in block_hashes if k in self.blocks)
+        manifest.assets.update((k, self.assets[k]) for k in asset_paths if k in self.assets)
+        return manifest
+
     def __str__(self):
         return '<Manifest %s assets:%s blocks:%s>' % (self.get_path(), self.assets, self.blocks)
 
@@ -45,6 +105,20 @@ class Manifest(object):
         compiled_asset_path = compiled_asset_path or self.settings["compiled_asset_root"]
         return os.path.join(compiled_asset_path, 'manifest.json')
 
+    @classmethod
+    def shared(cls, settings):
+        """Returns the process-wide manifest for the given settings'
+        compiled_asset_root, loading it from disk on first use.
+        """
+        return shared_manifests.get(settings)
+
+    @classmethod
+    def invalidate_shared(cls, compiled_asset_root=None):
+        """Drops the process-wide manifest for compiled_asset_root (or all of
+        them), forcing the next call to `shared` to reload it from disk.
+        """
+        shared_manifests.invalidate(compiled_asset_root)
+
     def load(self, compiled_asset_path=None):
         try:
             filename = self.get_path(compiled_asset_path)
@@ -57,12 +131,19 @@ class Manifest(object):
 
         return self
 
-    def write(self, compiled_asset_path=None, settings=None, **kwargs):
+    def write(self, compiled_asset_path=None, settings=None, indent=2, **kwargs):
+        """Atomically writes this manifest to disk, incrementing its
+        generation. Pass indent=None for compact output, which is noticeably
+        faster to write for large manifests.
+        """
         if settings is not None:
             self.settings = settings
         manifest_path = self.get_path(compiled_asset_path)
-        logging.info('Writing manifest to %s', manifest_path)
-        json.dump(self._manifest, open(manifest_path, 'w'), indent=2, **kwargs)
+        self.generation += 1
+        logging.info('Writing manifest generation %d to %s', self.generation, manifest_path)
+        with atomic_write(manifest_path) as f:
+            json.dump(self._manifest, f, indent=indent, **kwargs)
+        shared_manifests.invalidate(os.path.dirname(manifest_path))
 
     def make_empty_manifest(self):
         return {
@@ -110,3 +191,147 @@ class Manifest(object):
             logging.warning('Static assets out of sync')
         return assets_out_of_sync
 
+
+class RuntimeManifest(object):
+    """The subset of a manifest needed to render assets at runtime: just the
+    `versioned_path` of each block and asset, without the deps, versions and
+    other bookkeeping only needed by the compiler. It is written alongside
+    manifest.json as manifest.runtime.json and implements the same runtime
+    lookups as `Manifest`.
+    """
+
+    # Assigned by the shared manifest registry, see Manifest.load_id
+    load_id = 0
+
+    def __init__(self, blocks=None, assets=None, generation=0):
+        self.blocks = blocks or {}
+        self.assets = assets or {}
+        self.generation = generation
+
+    def __str__(self):
+        return '<RuntimeManifest assets:%s blocks:%s>' % (len(self.assets), len(self.blocks))
+
+    @classmethod
+    def get_path(cls, compiled_asset_path):
+        return os.path.join(compiled_asset_path, 'manifest.runtime.json')
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        assert isinstance(data['blocks'], dict)
+        assert isinstance(data['assets'], dict)
+        return cls(data['blocks'], data['assets'], data.get('generation', 0))
+
+    @classmethod
+    def write(cls, manifest, compiled_asset_path=None):
+        """Writes the runtime subset of the given manifest atomically."""
+        compiled_asset_path = compiled_asset_path or manifest.settings['compiled_asset_root']
+        runtime_path = cls.get_path(compiled_asset_path)
+        logging.info('Writing runtime manifest to %s', runtime_path)
+        data = {
+            'generation': manifest.generation,
+            'blocks': dict((k, v['versioned_path']) for k, v in manifest.blocks.items() if v.get('versioned_path')),
+            'assets': dict((k, v['versioned_path']) for k, v in manifest.assets.items() if v.get('versioned_path')),
+        }
+        with atomic_write(runtime_path) as f:
+            json.dump(data, f, separators=(',', ':'))
+        return runtime_path
+
+    def get_block_path(self, name_hash):
+        return self.blocks[name_hash]
+
+    def get_asset_path(self, path):
+        return self.assets[path]
+
+    def has_asset(self, path):
+        return path in self.assets
+
+    def is_empty(self):
+        return not (self.blocks or self.assets)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def load_runtime_manifest(settings):
+    """Loads the manifest used to render assets at runtime. In order of
+    preference, this is the binary manifest index, the slim runtime manifest
+    or manifest.json itself. The first two are only used if they are at least
+    as new as manifest.json, so assets compiled by older versions of assetman
+    (which only write manifest.json) are still served correctly.
+    """
+    compiled_asset_root = settings['compiled_asset_root']
+    json_mtime = _mtime(Manifest(settings).get_path())
+    loaders = [
+        (ManifestIndex.get_path(compiled_asset_root), ManifestIndex),
+        (RuntimeManifest.get_path(compiled_asset_root), RuntimeManifest.load),
+    ]
+    for path, loader in loaders:
+        mtime = _mtime(path)
+        if mtime is None or (json_mtime is not None and mtime < json_mtime):
+            continue
+        try:
+            return loader(path)
+        except (AssertionError, KeyError, ValueError, struct.error, OSError) as e:
+            logging.warning('error opening runtime manifest %s: %s', path, e)
+    return Manifest(settings).load()
+
+
+class ManifestRegistry(object):
+    """A thread-safe, process-wide cache of loaded manifests keyed by
+    compiled_asset_root, so that rendering asset blocks does not re-read and
+    re-parse manifest.json on every request.
+    """
+
+    def __init__(self):
+        self._manifests = {}
+        self._lock = threading.Lock()
+        self._load_ids = itertools.count(1)
+
+    def _key(self, compiled_asset_root):
+        return os.path.abspath(compiled_asset_root)
+
+    def get(self, settings):
+        key = self._key(settings['compiled_asset_root'])
+        manifest = self._manifests.get(key)
+        if manifest is None:
+            with self._lock:
+                manifest = self._manifests.get(key)
+                if manifest is None:
+                    manifest = load_runtime_manifest(settings)
+                    # An empty manifest usually means the file was missing or
+                    # unreadable, so don't pin it; try again next time.
+                    if not manifest.is_empty():
+                        manifest.load_id = next(self._load_ids)
+                        self._manifests[key] = manifest
+        return manifest
+
+    def get_loaded(self, compiled_asset_root):
+        """Returns the manifest currently cached for compiled_asset_root, or
+        None, without loading anything.
+        """
+        return self._manifests.get(self._key(compiled_asset_root))
+
+    def replace(self, compiled_asset_root, manifest):
+        """Atomically swaps in an already-loaded manifest for the given
+        compiled_asset_root.
+        """
+        key = self._key(compiled_asset_root)
+        with self._lock:
+            manifest.load_id = next(self._load_ids)
+            self._manifests[key] = manifest
+
+    def invalidate(self, compiled_asset_root=None):
+        with self._lock:
+            if compiled_asset_root is None:
+                self._manifests.clear()
+            else:
+                self._manifests.pop(self._key(compiled_asset_root), None)
+
+
+shared_manifests = ManifestRegistry()
@@ -0,0 +1,132 @@
+import os
+import mmap
+import struct
+import logging
+
+from assetman.tools import _utf8, atomic_write
+
+
+class ManifestIndex(object):
+    """A compact, read-only view of the `versioned_path` mappings in a
+    manifest, stored in a sorted binary file which is read through mmap and
+    searched by bisection. Because nothing is parsed into Python objects, the
+    index is cheap to open and its pages are shared between forked worker
+    processes.
+
+    The file is laid out as:
+
+        header:  magic, manifest generation, number of blocks, number of
+                 assets
+        tables:  one (offset, key length, value length) entry per block,
+                 then one per asset, each table sorted by key
+        heap:    the key bytes of each entry, immediately followed by the
+                 value bytes
+
+    It implements the same runtime lookups as `assetman.manifest.Manifest`.
+    """
+
+    MAGIC = b'AMIDX002'
+    HEADER = struct.Struct('<8sQII')
+    ENTRY = struct.Struct('<III')
+
+    # Assigned by the shared manifest registry, see Manifest.load_id
+    load_id = 0
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.generation, self._block_count, self._asset_count = self.HEADER.unpack_from(self._mmap, 0)
+        if magic != self.MAGIC:
+            self.close()
+            raise ValueError('%s is not a manifest index' % path)
+        self._blocks_offset = self.HEADER.size
+        self._assets_offset = self._blocks_offset + self._block_count * self.ENTRY.size
+
+    @classmethod
+    def read_generation(cls, path):
+        """Returns the manifest generation recorded in the index at path by
+        reading just its header, or None if it isn't a readable index.
+        """
+        try:
+            with open(path, 'rb') as f:
+                magic, generation, _, _ = cls.HEADER.unpack(f.read(cls.HEADER.size))
+        except (IOError, struct.error):
+            return None
+        return generation if magic == cls.MAGIC else None
+
+    def __str__(self):
+        return '<ManifestIndex %s assets:%s blocks:%s>' % (self.path, self._asset_count, self._block_count)
+
+    @classmethod
+    def get_path(cls, compiled_asset_path):
+        return os.path.join(compiled_asset_path, 'manifest.idx')
+
+    @classmethod
+    def write(cls, manifest, compiled_asset_path=None):
+        """Writes an index of the given manifest's blocks and assets. The
+        index is written atomically, so processes that have the old index
+        mapped are unaffected.
+        """
+        compiled_asset_path = compiled_asset_path or manifest.settings['compiled_asset_root']
+        index_path = cls.get_path(compiled_asset_path)
+        logging.info('Writing manifest index to %s', index_path)
+
+        sections = []
+        for entries in (manifest.blocks, manifest.assets):
+            sections.append(sorted(
+                (_utf8(key), _utf8(entry['versioned_path']))
+                for key, entry in entries.items()
+                if entry.get('versioned_path')))
+
+        tables = []
+        heap = []
+        offset = cls.HEADER.size + cls.ENTRY.size * sum(map(len, sections))
+        for section in sections:
+            for key, value in section:
+                tables.append(cls.ENTRY.pack(offset, len(key), len(value)))
+                heap.append(key + value)
+                offset += len(key) + len(value)
+
+        with atomic_write(index_path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, manifest.generation, len(sections[0]), len(sections[1])))
+            f.write(b''.join(tables))
+            f.write(b''.join(heap))
+        return index_path
+
+    def close(self):
+        self._mmap.close()
+
+    def is_empty(self):
+        return not (self._block_count or self._asset_count)
+
+    def _lookup(self, table_offset, count, key):
+        key = _utf8(key)
+        data = self._mmap
+        entry = self.ENTRY
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset, key_len, value_len = entry.unpack_from(data, table_offset + mid * entry.size)
+            candidate = data[offset:offset + key_len]
+            if candidate < key:
+                lo = mid + 1
+            elif candidate > key:
+                hi = mid
+            else:
+                value_offset = offset + key_len
+                return data[value_offset:value_offset + value_len].decode('utf-8')
+        raise KeyError(key.decode('utf-8'))
+
+    def get_block_path(self, name_hash):
+        return self._lookup(self._blocks_offset, self._block_count, name_hash)
+
+    def get_asset_path(self, path):
+        return self._lookup(self._assets_offset, self._asset_count, path)
+
+    def has_asset(self, path):
+        try:
+            self.get_asset_path(path)
+        except KeyError:
+            return False
+        return True
@@ -0,0 +1,69 @@
+import os
+import sys
+import stat
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from assetman.closure_server import ClosureServer
+from assetman.compilers import JSCompiler, CompileError
+from assetman.settings import Settings
+
+# Stands in for the JVM: listens on the host:port given as its last argument
+FAKE_SERVER = '''#!%s
+import sys, time, socket
+host, port = sys.argv[-1].split(':')
+sock = socket.socket()
+sock.bind((host, int(port)))
+sock.listen(5)
+time.sleep(60)
+''' % sys.executable
+
+
+class TestClosureServer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(suffix='.assetman_tests')
+        self.settings = Settings(
+            static_dir='./assetman/tests/static_dir',
+            static_url_prefix='/static/',
+            closure_compiler=os.path.join(self.tmp_dir, 'compiler.jar'),
+            closure_nailgun_jar='nailgun-server.jar',
+            java_bin=os.path.join(self.tmp_dir, 'java'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_start_and_stop(self):
+        with open(self.settings['java_bin'], 'w') as f:
+            f.write(FAKE_SERVER)
+        os.chmod(self.settings['java_bin'], stat.S_IRWXU)
+
+        server = ClosureServer(self.settings)
+        assert server.start(timeout=10)
+        assert server.is_running()
+        cmd = server.get_command()
+        assert cmd[0] == 'ng'
+        assert cmd[-1] == ClosureServer.main_class
+        assert str(server.port) in cmd
+        server.stop()
+        assert not server.is_running()
+
+    def test_start_failure(self):
+        server = ClosureServer(self.settings)
+        assert not server.start(timeout=1)
+        assert not server.is_running()
+
+    def test_compiler_falls_back_to_new_jvm(self):
+        for key in ('java_bin', 'closure_compiler'):
+            open(self.settings[key], 'w').close()
+        compiler = JSCompiler('test.js', settings=self.settings)
+        closure_command = ['ng', ClosureServer.main_class]
+        with mock.patch('assetman.compilers.run_proc') as run_proc:
+            run_proc.side_effect = [CompileError(closure_command, 'connect failed'), 'compiled']
+            assert compiler.compile(closure_command=closure_command) == 'compiled'
+        server_cmd, jvm_cmd = [call[0][0] for call in run_proc.call_args_list]
+        assert server_cmd[:2] == closure_command
+        assert jvm_cmd[0] == self.settings['java_bin']
+        assert server_cmd[2:] == jvm_cmd[jvm_cmd.index(self.settings['closure_compiler']) + 1:]
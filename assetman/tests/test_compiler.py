@@ -2,12 +2,25 @@
 from . import test_shunt # pyflakes.ignore
 
 import contextlib
+from unittest import mock
 
 from assetman.settings import Settings
+from assetman.manifest import Manifest
+from assetman.build_cache import BuildCache
+from assetman.compile_stats import CompileStats
+from assetman.disk_cache import DiskCache
 from assetman.compile import NeedsCompilation
+from assetman.compilers import JSCompiler, CSSCompiler, LessCompiler, CompileError, get_lessc_threads, run_proc
+from assetman.managers import JSManager
 from assetman.S3UploadThread import upload_assets_to_s3
 import assetman.compile
+import assetman.tools
+import assetman.compilers
+import os
+import shutil
+import sys
 import tempfile
+import time
 import logging
 
 COMPILED_ASSET_DIR=tempfile.mkdtemp(suffix='.assetman_tests')
@@ -81,6 +94,154 @@ def test_needs_compile():
     assert len(files_to_upload) == 3
     
 
+@contextlib.contextmanager
+def temporary_static_dir(files):
+    """When used in a with block, creates a temporary static dir containing
+    the given {relative path: contents} files and yields its path.
+    """
+    static_dir = tempfile.mkdtemp(suffix='.assetman_static')
+    for rel_path, contents in files.items():
+        path = os.path.join(static_dir, rel_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(contents)
+    try:
+        yield static_dir
+    finally:
+        shutil.rmtree(static_dir)
+
+def test_needs_compile_fast_path_uses_fingerprint():
+    run_compiler(test_needs_compile=False)
+    run_compiler()
+
+    # With nothing changed, -t must not need to build the manifest at all
+    with mock.patch.object(assetman.compile, 'build_manifest', side_effect=AssertionError):
+        manifest = run_compiler()
+    assert len(manifest.blocks) == 2
+
+    # But any change to a source file means a full check
+    with temporarily_alter_contents('static_dir/test.js', '\n'):
+        try:
+            run_compiler()
+            raise Exception("should need compile")
+        except NeedsCompilation:
+            pass
+
+def test_parallel_template_parsing():
+    settings = get_settings()
+    template_dir = settings['tornado_template_dirs'][0]
+    path_infos = [(os.path.join(template_dir, 'tornado_test_template.html'), 'tornado_template')] * 4
+
+    settings['jobs'] = 1
+    serial = assetman.compile.build_compilers(path_infos, settings)
+    settings['jobs'] = 2
+    parallel = assetman.compile.build_compilers(path_infos, settings)
+    assert len(serial) == len(parallel) == 8
+    assert [c.get_hash() for c in serial] == [c.get_hash() for c in parallel]
+
+def test_parallel_template_parsing_reports_errors():
+    settings = get_settings()
+    settings['jobs'] = 2
+    template_dir = tempfile.mkdtemp(dir='assetman/tests')
+    try:
+        bad_path = os.path.join(template_dir, 'bad.html')
+        with open(bad_path, 'w') as f:
+            f.write('{% apply assetman.include_js %}test.js')
+        good_path = os.path.join(settings['tornado_template_dirs'][0], 'tornado_test_template.html')
+        path_infos = [(good_path, 'tornado_template'), (bad_path, 'tornado_template')]
+        try:
+            assetman.compile.build_compilers(path_infos, settings)
+            raise Exception('should have raised ParseError')
+        except assetman.compile.ParseError as e:
+            src_path, msg = e.args
+            assert src_path == bad_path, src_path
+            assert 'Missing {% end %}' in msg, msg
+            assert 'Traceback' in e.traceback, e.traceback
+    finally:
+        shutil.rmtree(template_dir)
+
+def test_scan_threads_are_opt_in():
+    settings = get_settings()
+    template_paths = list(assetman.tools.iter_template_paths(settings['tornado_template_dirs'], settings['template_extension']))
+    with mock.patch('concurrent.futures.ThreadPoolExecutor', side_effect=AssertionError):
+        serial, _ = assetman.compile.build_manifest(template_paths, settings)
+    settings['scan_threads'] = 4
+    threaded, _ = assetman.compile.build_manifest(template_paths, settings)
+    assert serial.assets == threaded.assets
+
+def test_dependency_graph_scans_each_file_once():
+    # a diamond: a imports b and c, which both import d (and each other)
+    files = {
+        'a.css': '@import "b.css";\n@import "c.css";',
+        'b.css': '@import "d.css";\n@import "c.css";',
+        'c.css': '@import "d.css";\n@import "b.css";',
+        'd.css': 'body { background: url(/static/img.png); }',
+        'img.png': '',
+    }
+    with temporary_static_dir(files) as static_dir:
+        manifest = Manifest(get_settings())
+        paths = [os.path.join(static_dir, 'a.css')]
+        scanned = assetman.compile._build_manifest_helper(static_dir, paths, '/static/', manifest)
+        assert scanned == 5, scanned
+        assert sorted(manifest.assets) == sorted(files)
+        assert manifest.assets['a.css']['deps'] == set(['b.css', 'c.css'])
+        assert manifest.assets['b.css']['deps'] == set(['c.css', 'd.css'])
+        assert manifest.assets['d.css']['deps'] == set(['img.png'])
+
+def test_build_cache_reuses_unchanged_files():
+    files = {'a.css': 'body { background: url(/static/img.png); }', 'img.png': ''}
+    with temporary_static_dir(files) as static_dir:
+        settings = get_settings()
+        settings['static_dir'] = static_dir
+        path = os.path.join(static_dir, 'a.css')
+        scan = lambda: assetman.compile.scan_file(static_dir, path, '/static/')
+        img_path = os.path.join(static_dir, 'img.png')
+
+        build_cache = BuildCache(settings)
+        file_hash, deps, missing = build_cache.get_scan(path, scan)
+        assert deps == [img_path] and missing == []
+        assert file_hash == assetman.compile.get_file_hash(path)
+        build_cache.save()
+
+        build_cache = BuildCache(settings).load()
+        assert build_cache.get_scan(path, lambda: 1 / 0) == (file_hash, [img_path], [])
+        assert build_cache.get_file_hash(path, lambda: 1 / 0) == file_hash
+        assert build_cache.misses == 0
+
+        # a dependency disappearing forces a rescan
+        os.rename(img_path, img_path + '.bak')
+        assert build_cache.get_scan(path, scan).deps == []
+        os.rename(img_path + '.bak', img_path)
+        assert build_cache.get_scan(path, scan).deps == [img_path]
+
+        assert build_cache.validate(assetman.compile.get_file_hash) == []
+        build_cache._entries[path]['hash'] = 'abc'
+        assert build_cache.validate(assetman.compile.get_file_hash) == [path]
+
+        # changing the file invalidates its entry
+        with open(path, 'a') as f:
+            f.write('\n')
+        assert build_cache.get_file_hash(path, lambda: 'def') == 'def'
+
+
+def test_scan_file_reads_each_reference_kind():
+    files = {
+        'a.scss': '@import "b.scss";\n@import "compass/css3";\n.x { background: url(/static/img.png); }\n',
+        'b.scss': '.y { background: url("/static/gone.png"); }',
+        'img.png': '',
+    }
+    with temporary_static_dir(files) as static_dir:
+        path = os.path.join(static_dir, 'a.scss')
+        result = assetman.compile.scan_file(static_dir, path, '/static/')
+        assert result.hash == assetman.compile.get_file_hash(path)
+        assert result.deps == [os.path.join(static_dir, 'b.scss'), os.path.join(static_dir, 'img.png')]
+        assert result.missing == []
+
+        result = assetman.compile.scan_file(static_dir, os.path.join(static_dir, 'b.scss'), '/static/')
+        assert result.deps == []
+        assert result.missing == [os.path.join(static_dir, 'gone.png')]
+
 @contextlib.contextmanager
 def temporarily_alter_contents(path, data):
     """When used in a with block, temporarily changes the contents of a file
@@ -190,3 +351,551 @@ def temporarily_alter_contents(path, data):
 #     assert re.search(r'(?m)^/cdn/76445780cfa7095a8e65a3d730688760\.js$', result)
 #     assert '<script src="/cdn/f022be20475cb50d7050f1a45a715795.js" type="text/javascript"></script>' in result
 #     assert settings.get('cdn_url_prefix')[0] not in result
+
+
+def test_version_dependencies_handles_deep_chains():
+    settings = get_settings()
+    manifest = Manifest(settings)
+    depth = 5000
+    for i in range(depth):
+        entry = assetman.compile.empty_asset_entry()
+        if i + 1 < depth:
+            entry['deps'].add('c%d.css' % (i + 1))
+        manifest.assets['c%d.css' % i] = entry
+    file_hashes = dict(('c%d.css' % i, 'h%d' % i) for i in range(depth))
+    versioned = assetman.compile.version_dependencies(manifest, file_hashes=file_hashes)
+    assert len(versioned) == depth
+    assert all(entry['version'] for entry in manifest.assets.values())
+
+
+def test_version_dependencies_reports_cycles():
+    settings = get_settings()
+    manifest = Manifest(settings)
+    for path, dep in [('a.less', 'b.less'), ('b.less', 'c.less'), ('c.less', 'a.less')]:
+        manifest.assets[path] = assetman.compile.empty_asset_entry()
+        manifest.assets[path]['deps'].add(dep)
+    try:
+        assetman.compile.version_dependencies(manifest, file_hashes={})
+        raise Exception('should have raised DependencyError')
+    except assetman.compile.DependencyError as e:
+        assert e.args == ('a.less', 'dependency cycle: a.less -> b.less -> c.less -> a.less')
+
+
+def test_hash_algorithm_setting():
+    settings = get_settings()
+    template_paths = list(assetman.tools.iter_template_paths(settings['tornado_template_dirs'], settings['template_extension']))
+    md5_manifest, _ = assetman.compile.build_manifest(template_paths, settings)
+    assert md5_manifest.hash_algorithm == 'md5'
+
+    settings['hash_algorithm'] = 'blake2b'
+    settings['hash_digest_size'] = 20
+    manifest, compilers = assetman.compile.build_manifest(template_paths, settings)
+    assert manifest.hash_algorithm == 'blake2b-20'
+    assert set(manifest.assets) == set(md5_manifest.assets)
+    for path, entry in manifest.assets.items():
+        assert len(entry['version']) == 40
+        assert entry['version'] != md5_manifest.assets[path]['version']
+    for name_hash, entry in manifest.blocks.items():
+        # block names are lookup keys, so they stay md5
+        assert name_hash in md5_manifest.blocks
+        assert len(entry['version']) == 40
+
+
+
+def test_bad_hash_algorithm_settings_are_rejected_up_front():
+    for algorithm, digest_size in [('md5', 20), ('shake_128', None), ('nope', None), ('blake2b', 99)]:
+        settings = get_settings()
+        settings['hash_algorithm'] = algorithm
+        settings['hash_digest_size'] = digest_size
+        with mock.patch.object(assetman.compile, 'build_manifest', side_effect=AssertionError):
+            try:
+                assetman.compile.run(settings)
+                raise Exception('should have failed')
+            except Exception as e:
+                assert str(e).startswith('invalid hash algorithm'), e
+
+        args = ['--hash-algorithm', algorithm] + (['--hash-digest-size', str(digest_size)] if digest_size else [])
+        options, _ = assetman.compile.parser.parse_args(args)
+        with mock.patch.object(assetman.compile.parser, 'error', side_effect=SystemExit) as error:
+            try:
+                assetman.compile._create_settings(options)
+                raise Exception('should have failed')
+            except SystemExit:
+                pass
+        assert error.call_args[0][0].startswith('invalid hash algorithm')
+
+def test_hash_algorithm_is_not_needed_at_runtime():
+    tools_dir = tempfile.mkdtemp(suffix='.assetman_tests')
+    compiled_asset_root = tempfile.mkdtemp(suffix='.assetman_tests')
+    try:
+        for name in ('java', 'minify'):
+            path = os.path.join(tools_dir, name)
+            with open(path, 'w') as f:
+                f.write('#!/bin/sh\ncat\n')
+            os.chmod(path, 0o755)
+        settings = get_settings(test_needs_compile=False, closure_compiler=__file__,
+                                minify_compressor_path=os.path.join(tools_dir, 'minify'))
+        settings['compiled_asset_root'] = compiled_asset_root
+        settings['java_bin'] = os.path.join(tools_dir, 'java')
+        settings['hash_algorithm'] = 'blake2b'
+        settings['hash_digest_size'] = 16
+        manifest = assetman.compile.run(settings)
+        assert manifest.hash_algorithm == 'blake2b-16'
+
+        # The app's settings know nothing about the compiler's hash algorithm
+        runtime_settings = Settings(
+            compiled_asset_root=compiled_asset_root,
+            enable_static_compilation=False,
+            static_url_prefix='/static/',
+            local_cdn_url_prefix='/cdn/')
+        Manifest.invalidate_shared()
+        result = JSManager.include('test.js', settings=runtime_settings, local=True)
+        versioned_path = manifest.blocks[JSManager('test.js', settings=settings).get_hash()]['versioned_path']
+        assert result == '<script src="/cdn/%s" type="text/javascript"></script>' % versioned_path, result
+    finally:
+        Manifest.invalidate_shared()
+        shutil.rmtree(tools_dir)
+        shutil.rmtree(compiled_asset_root)
+
+
+def test_get_file_hash_through_mmap():
+    with temporary_static_dir({'big.js': 'x' * 4096}) as static_dir:
+        path = os.path.join(static_dir, 'big.js')
+        expected = assetman.compile.get_file_hash(path)
+        with mock.patch('assetman.compile.mmap_hash_threshold', 1024):
+            assert assetman.compile.get_file_hash(path) == expected
+
+
+def test_batch_js_compilers():
+    files = {'a.js': '', 'b.js': '', 'c.js': '', 'd.css': ''}
+    with temporary_static_dir(files) as static_dir:
+        settings = get_settings()
+        settings['static_dir'] = static_dir
+        ab = JSCompiler('a.js b.js', settings=settings)
+        bc = JSCompiler('b.js c.js', settings=settings)
+        c = JSCompiler('c.js', settings=settings)
+        a = JSCompiler('a.js', settings=settings)
+        css = CSSCompiler('d.css', settings=settings)
+        items = assetman.compile.batch_js_compilers([ab, bc, css, c, a], 3)
+        # bc shares b.js with ab, and a shares a.js with ab, so they can't
+        # go in its batch
+        assert items == [css, [ab, c], [bc, a]]
+        assert assetman.compile.batch_js_compilers([ab, c], 1) == [ab, c]
+
+
+# Stands in for `java -jar compiler.jar` from the closure compiler release
+# used in CI (compiler-20150315), which only knows --module for batches
+FAKE_CLOSURE_2015 = """#!%s
+import sys
+args = sys.argv[4:]
+js, modules, prefix = [], [], None
+for flag, value in zip(args[::2], args[1::2]):
+    if flag == '--js':
+        js.append(value)
+    elif flag == '--module':
+        modules.append(value)
+    elif flag == '--module_output_path_prefix':
+        prefix = value
+    elif flag not in ('--compilation_level', '--language_in'):
+        sys.exit('"%%s" is not a valid option' %% flag)
+for spec in modules:
+    name, count = spec.split(':')[:2]
+    with open(prefix + name + '.js', 'w') as out:
+        for _ in range(int(count)):
+            out.write(open(js.pop(0)).read())
+""" % sys.executable
+
+def test_compile_js_batch():
+    with temporary_static_dir({'a.js': 'var a;', 'b.js': 'var b;', 'c.js': 'var c;', 'java': FAKE_CLOSURE_2015}) as static_dir:
+        settings = get_settings(closure_compiler=__file__, minify_compressor_path=__file__)
+        settings['static_dir'] = static_dir
+        settings['java_bin'] = os.path.join(static_dir, 'java')
+        os.chmod(settings['java_bin'], 0o755)
+        compilers = [JSCompiler('a.js b.js', settings=settings), JSCompiler('c.js', settings=settings)]
+        assert JSCompiler.compile_batch(compilers) == ['var a;var b;', 'var c;']
+
+        # Newer releases call modules chunks
+        settings['closure_chunk_flag'] = '--chunk'
+        try:
+            JSCompiler.compile_batch(compilers)
+            raise Exception('should have failed')
+        except CompileError as e:
+            assert b'not a valid option' in e.args[1], e
+
+        options, _ = assetman.compile.parser.parse_args(['--closure-chunk-flag', '--chunk'])
+        assert assetman.compile._create_settings(options)['closure_chunk_flag'] == '--chunk'
+
+
+def test_css_minify_cache_is_shared_between_blocks():
+    files = {'vendor.css': '.v { color: red; }', 'a.css': '.a { color: blue; }', 'b.css': '.b { color: green; }'}
+    with temporary_static_dir(files) as static_dir:
+        settings = get_settings(minify_compressor_path=__file__)
+        settings['static_dir'] = static_dir
+        settings['compiled_asset_root'] = static_dir
+        manifest = Manifest(settings)
+        for path in files:
+            manifest.assets[path] = {'version': 'v1-' + path, 'versioned_path': None, 'deps': []}
+
+        def compile_block(rel_urls):
+            compiler = CSSCompiler(rel_urls, settings=settings)
+            compiler.manifest = manifest
+            return compiler.compile(skip_inline_images=True)
+
+        fake_minify = lambda cmd, stdin, stdout=None: stdin.replace(' ', '')
+        with mock.patch('assetman.compilers.run_proc', side_effect=fake_minify) as run_proc:
+            assert compile_block('vendor.css a.css') == '.v{color:red;}\n.a{color:blue;}'
+            assert run_proc.call_count == 2
+            assert compile_block('vendor.css b.css') == '.v{color:red;}\n.b{color:green;}'
+            assert run_proc.call_count == 3
+
+            # a new version of a file is minified again
+            manifest.assets['vendor.css']['version'] = 'v2'
+            compile_block('vendor.css a.css')
+            assert run_proc.call_count == 4
+
+            settings['skip_minify_cache'] = True
+            assert compile_block('vendor.css a.css') == '.v{color:red;}\n.a{color:blue;}'
+            assert run_proc.call_count == 5
+
+
+
+
+def test_minify_cache_reports_missing_compressor():
+    with temporary_static_dir({'a.css': '.a { color: blue; }'}) as static_dir:
+        settings = get_settings(minify_compressor_path=os.path.join(static_dir, 'no-minify'))
+        settings['static_dir'] = static_dir
+        settings['compiled_asset_root'] = static_dir
+        compiler = CSSCompiler('a.css', settings=settings)
+        compiler.manifest = Manifest(settings)
+        compiler.manifest.assets['a.css'] = {'version': 'v1', 'versioned_path': 'v1.css', 'deps': []}
+        try:
+            compiler.compile(skip_inline_images=True)
+            raise Exception('should have failed')
+        except AssertionError as e:
+            assert 'settings key minify_compressor_path' in str(e), e
+
+def test_disk_caches_are_pruned_when_unused():
+    cache_dir = tempfile.mkdtemp(suffix='.assetman_tests')
+    try:
+        settings = get_settings()
+        settings['cache_dir'] = cache_dir
+        cache = DiskCache.from_settings(settings, 'minify_cache')
+        assert cache.root == os.path.join(cache_dir, 'minify_cache')
+        cache.set('aa11', 'old')
+        cache.set('bb22', 'used')
+        long_ago = time.time() - 30 * 24 * 60 * 60
+        for key in ('aa11', 'bb22'):
+            os.utime(cache.get_path(key), (long_ago, long_ago))
+
+        # reading an entry marks it as used
+        assert cache.get('bb22') == 'used'
+        assetman.compile.prune_disk_caches(settings)
+        assert cache.get('aa11') is None
+        assert cache.get('bb22') == 'used'
+
+        settings['cache_max_age'] = 0
+        assetman.compile.prune_disk_caches(settings)
+        assert cache.get('bb22') is None
+    finally:
+        shutil.rmtree(cache_dir)
+
+def test_less_compiler_runs_lessc_concurrently_in_order():
+    files = dict(('f%d.less' % i, '') for i in range(8))
+    with temporary_static_dir(files) as static_dir:
+        settings = get_settings(lessc_path=__file__, minify_compressor_path=__file__)
+        settings['static_dir'] = static_dir
+        compiler = LessCompiler(' '.join('f%d.less' % i for i in range(8)), settings=settings)
+        running = []
+        max_running = []
+
+        def fake_run_proc(cmd, stdin=None, stdout=None):
+            if stdin is not None:
+                return stdin
+            running.append(cmd)
+            max_running.append(len(running))
+            # later files finish first
+            time.sleep(0.01 * (8 - int(os.path.basename(cmd[1])[1])))
+            running.remove(cmd)
+            return os.path.basename(cmd[1])
+
+        with mock.patch('assetman.compilers.run_proc', side_effect=fake_run_proc):
+            output = compiler.compile(skip_inline_images=True, lessc_threads=4)
+        assert output == '\n'.join('f%d.less' % i for i in range(8))
+        assert max(max_running) == 4
+
+
+def test_get_lessc_threads():
+    with mock.patch('multiprocessing.cpu_count', return_value=8):
+        assert get_lessc_threads({}) == 1
+        assert get_lessc_threads({}, concurrent_blocks=2) == 4
+        assert get_lessc_threads({'jobs': 2}) == 4
+        assert get_lessc_threads({'jobs': 16}, concurrent_blocks=32) == 1
+        assert get_lessc_threads({'lessc_threads': 3}) == 3
+
+
+def test_compile_stats_schedule_longest_first():
+    with temporary_static_dir({'a.js': '', 'b.js': '', 'c.js': '', 'd.js': ''}) as static_dir:
+        settings = get_settings()
+        settings['static_dir'] = static_dir
+        settings['compiled_asset_root'] = static_dir
+        a, b, c, d = [JSCompiler(name, settings=settings) for name in ('a.js', 'b.js', 'c.js', 'd.js')]
+
+        stats = CompileStats(settings)
+        assert stats.schedule([a, b]) == [a, b]
+        stats.record(a.get_hash(), 1.0)
+        stats.record(b.get_hash(), 5.0)
+        stats.record(c.get_hash(), 2.0)
+        stats.save()
+
+        stats = CompileStats(settings).load()
+        # d has no history, so is assumed to take the average (2.67s)
+        assert stats.schedule([a, b, c, d]) == [b, d, c, a]
+        assert stats.schedule([a, [a, c], b]) == [b, [a, c], a]
+
+
+def test_compiler_manifest_subset():
+    with temporary_static_dir({'a.js': '', 'b.js': '', 'c.js': ''}) as static_dir:
+        settings = get_settings()
+        settings['static_dir'] = static_dir
+        compiler = JSCompiler('a.js b.js', settings=settings)
+        manifest = Manifest(settings)
+        for path in ('a.js', 'b.js', 'c.js'):
+            manifest.assets[path] = {'version': path, 'versioned_path': path, 'deps': []}
+        manifest.blocks[compiler.get_hash()] = {'version': 'abc', 'versioned_path': 'abc.js'}
+        manifest.blocks['other'] = {'version': 'def', 'versioned_path': 'def.js'}
+
+        compiler.manifest = compiler.get_manifest_subset(manifest)
+        assert sorted(compiler.manifest.assets) == ['a.js', 'b.js']
+        assert list(compiler.manifest.blocks) == [compiler.get_hash()]
+        assert compiler.get_compiled_path() == os.path.join(settings['compiled_asset_root'], 'abc.js')
+
+
+def test_run_proc_streams_to_file():
+    with tempfile.TemporaryFile() as f:
+        f.write(b'before\n')
+        assert run_proc([sys.executable, '-c', 'print("output")'], stdout=f) is None
+        f.write(b'after\n')
+        f.seek(0)
+        assert f.read() == b'before\noutput\nafter\n'
+
+
+def test_compile_to_file_never_leaves_partial_output():
+    with temporary_static_dir({'a.css': '.a { color: red; }'}) as static_dir:
+        settings = get_settings(minify_compressor_path=__file__)
+        settings['static_dir'] = static_dir
+        settings['compiled_asset_root'] = static_dir
+        settings['skip_minify_cache'] = True
+        compiler = CSSCompiler('a.css', settings=settings)
+        path = os.path.join(static_dir, 'out.css')
+
+        def failing_minify(cmd, stdin=None, stdout=None):
+            stdout.write(b'.a{col')
+            raise CompileError(cmd, 'killed')
+
+        with mock.patch('assetman.compilers.run_proc', side_effect=failing_minify):
+            try:
+                compiler.compile_to_file(path, skip_inline_images=True)
+                raise Exception('should have raised CompileError')
+            except CompileError:
+                pass
+        assert sorted(os.listdir(static_dir)) == ['a.css']
+
+        def minify(cmd, stdin=None, stdout=None):
+            stdout.write(stdin.replace(' ', '').encode())
+
+        with mock.patch('assetman.compilers.run_proc', side_effect=minify):
+            compiler.compile_to_file(path, skip_inline_images=True)
+        with open(path) as f:
+            assert f.read() == '.a{color:red;}'
+
+
+def test_keep_going_records_successful_blocks():
+    tools_dir = tempfile.mkdtemp(suffix='.assetman_tests')
+    compiled_asset_root = tempfile.mkdtemp(suffix='.assetman_tests')
+    try:
+        def write_tool(name, body):
+            path = os.path.join(tools_dir, name)
+            with open(path, 'w') as f:
+                f.write('#!/bin/sh\n' + body + '\n')
+            os.chmod(path, 0o755)
+            return path
+
+        minify_log = os.path.join(tools_dir, 'minify.log')
+        settings = get_settings(test_needs_compile=False, closure_compiler=__file__,
+                                minify_compressor_path=write_tool('minify', 'echo run >> %s; cat' % minify_log))
+        settings['compiled_asset_root'] = compiled_asset_root
+        settings['java_bin'] = write_tool('java', 'echo "syntax error" >&2; exit 1')
+        settings['keep_going'] = True
+
+        try:
+            assetman.compile.run(settings)
+            raise Exception('should have failed')
+        except Exception as e:
+            assert str(e) == 'Compilation Failed: 1 of 2 blocks failed', e
+        manifest = Manifest(settings).load()
+        assert len(manifest.blocks) == 1
+        assert [os.path.splitext(entry['versioned_path'])[1] for entry in manifest.blocks.values()] == ['.css']
+        assert not os.path.exists(assetman.compile.get_fingerprint_path(settings))
+        with open(minify_log) as f:
+            assert f.read().count('run') == 1
+
+        # once the JS is fixed, only its block is compiled
+        write_tool('java', 'echo "compiled"')
+        manifest = assetman.compile.run(settings)
+        assert len(manifest.blocks) == 2
+        with open(minify_log) as f:
+            assert f.read().count('run') == 1
+    finally:
+        shutil.rmtree(tools_dir)
+        shutil.rmtree(compiled_asset_root)
+
+
+
+def test_keep_going_records_input_errors():
+    root = tempfile.mkdtemp(suffix='.assetman_tests')
+    try:
+        files = {
+            'templates/t.html': ('{% apply assetman.include_css %}\na.css\n{% end %}\n'
+                                 '{% apply assetman.include_js %}\na.js\n{% end %}\n'),
+            'static/a.css': '.a { background: url(/static/missing.png); }',
+            'static/a.js': 'var a;',
+            'tools/cat': '#!/bin/sh\ncat\n',
+        }
+        for rel_path, contents in files.items():
+            path = os.path.join(root, rel_path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(contents)
+        os.chmod(os.path.join(root, 'tools/cat'), 0o755)
+
+        settings = get_settings(test_needs_compile=False, closure_compiler=__file__,
+                                minify_compressor_path=os.path.join(root, 'tools/cat'))
+        settings['static_dir'] = os.path.join(root, 'static')
+        # the template parser needs a relative template dir
+        settings['tornado_template_dirs'] = [os.path.relpath(os.path.join(root, 'templates'))]
+        settings['compiled_asset_root'] = os.path.join(root, 'compiled')
+        settings['java_bin'] = os.path.join(root, 'tools/cat')
+        settings['skip_inline_images'] = False
+        settings['keep_going'] = True
+
+        # The CSS block can't inline its missing image, but the JS block is
+        # still compiled and recorded
+        try:
+            assetman.compile.run(settings)
+            raise Exception('should have failed')
+        except Exception as e:
+            assert str(e) == 'Compilation Failed: 1 of 2 blocks failed', e
+        manifest = Manifest(settings).load()
+        assert [os.path.splitext(entry['versioned_path'])[1] for entry in manifest.blocks.values()] == ['.js']
+    finally:
+        shutil.rmtree(root)
+
+def test_inline_images_caches_data_uris_by_version():
+    files = {'a.css': '.a { background: url(/static/img.png); }', 'img.png': 'PNG', 'big.png': 'x' * 30000}
+    with temporary_static_dir(files) as static_dir:
+        settings = get_settings()
+        settings['static_dir'] = static_dir
+        settings['compiled_asset_root'] = static_dir
+        manifest = Manifest(settings)
+        manifest.assets['img.png'] = {'version': 'v1', 'versioned_path': 'v1.png', 'deps': []}
+        manifest.assets['big.png'] = {'version': 'v2', 'versioned_path': 'v2.png', 'deps': []}
+        compiler = CSSCompiler('a.css', settings=settings)
+        compiler.manifest = manifest
+        css = 'x { background: url(/static/img.png); } y { background: url("/static/big.png"); }'
+        expected = 'x { background: url(data:image/png;base64,UE5H); } y { background: url("/static/big.png"); }'
+
+        assetman.compilers.data_uri_memo.clear()
+        assert compiler.inline_images(css) == expected
+
+        # Later lookups, in this process or a new one, don't touch the images
+        with mock.patch('assetman.compilers.make_data_uri', side_effect=AssertionError) as make_data_uri:
+            assert compiler.inline_images(css) == expected
+            assetman.compilers.data_uri_memo.clear()
+            assert compiler.inline_images(css) == expected
+
+            # but a new version of an image is looked at again
+            manifest.assets['img.png']['version'] = 'v3'
+            make_data_uri.side_effect = None
+            make_data_uri.return_value = 'data:new'
+            assert compiler.inline_images(css).startswith('x { background: url(data:new); }')
+            assert make_data_uri.call_count == 1
+
+
+def test_data_uri_cache_key_covers_extension():
+    files = {'font.ttf': 'FONT', 'font.otf': 'FONT'}
+    with temporary_static_dir(files) as static_dir:
+        settings = get_settings()
+        settings['static_dir'] = static_dir
+        settings['compiled_asset_root'] = static_dir
+        manifest = Manifest(settings)
+        # byte-identical copies have the same version
+        for path in files:
+            manifest.assets[path] = {'version': 'v1', 'versioned_path': 'v1.' + path[-3:], 'deps': []}
+        compiler = CSSCompiler('font.ttf', settings=settings)
+        compiler.manifest = manifest
+
+        assetman.compilers.data_uri_memo.clear()
+        ttf = compiler.get_data_uri('font.ttf')
+        otf = compiler.get_data_uri('font.otf')
+        assert ttf != otf
+        assert ttf == assetman.compilers.make_data_uri(os.path.join(static_dir, 'font.ttf'))
+        assert otf == assetman.compilers.make_data_uri(os.path.join(static_dir, 'font.otf'))
+
+
+def test_data_uri_memo_is_bounded():
+    assetman.compilers.data_uri_memo.clear()
+    with mock.patch('assetman.compilers.DATA_URI_MEMO_SIZE', 2):
+        for key in ('a', 'b', 'c'):
+            assetman.compilers.memoize_data_uri(key, 'data:' + key)
+    assert list(assetman.compilers.data_uri_memo) == ['b', 'c']
+    assetman.compilers.data_uri_memo.clear()
+
+
+def test_needs_compile_fast_path_sees_inputs_outside_static_dir():
+    root = tempfile.mkdtemp(suffix='.assetman_tests')
+    try:
+        files = {
+            'templates/t.html': '{% apply assetman.include_js %}\nvendor/v.js\n../lib.js\n{% end %}\n',
+            'vendor/v.js': 'var v = 1;',
+            'lib.js': 'var lib = 1;',
+            'static/.keep': '',
+            'tools/java': '#!/bin/sh\ncat\n',
+        }
+        for rel_path, contents in files.items():
+            path = os.path.join(root, rel_path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(contents)
+        os.chmod(os.path.join(root, 'tools/java'), 0o755)
+        os.symlink('../vendor', os.path.join(root, 'static/vendor'))
+
+        settings = get_settings(test_needs_compile=False, closure_compiler=__file__)
+        settings['static_dir'] = os.path.join(root, 'static')
+        # the template parser needs a relative template dir
+        settings['tornado_template_dirs'] = [os.path.relpath(os.path.join(root, 'templates'))]
+        settings['compiled_asset_root'] = os.path.join(root, 'compiled')
+        settings['java_bin'] = os.path.join(root, 'tools/java')
+        assetman.compile.run(settings)
+        settings['test_needs_compile'] = True
+        with mock.patch.object(assetman.compile, 'build_manifest', side_effect=AssertionError):
+            assetman.compile.run(settings)
+
+        # Both a file under a symlinked dir and one outside static_dir are
+        # noticed by -t
+        for rel_path in ('vendor/v.js', 'lib.js'):
+            path = os.path.join(root, rel_path)
+            with open(path) as f:
+                contents = f.read()
+            with open(path, 'a') as f:
+                f.write('\n')
+            try:
+                assetman.compile.run(settings)
+                raise Exception("should need compile")
+            except NeedsCompilation:
+                pass
+            with open(path, 'w') as f:
+                f.write(contents)
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,78 @@
+import sys
+import time
+import threading
+import unittest
+import multiprocessing
+
+from assetman.compilers import run_proc
+from assetman.jobserver import JobServer, set_jobserver
+import assetman.jobserver
+
+SLEEP = [sys.executable, '-c', 'import time; time.sleep(0.2)']
+
+def run_sleep(_):
+    run_proc(SLEEP)
+
+
+class TestJobServer(unittest.TestCase):
+
+    def tearDown(self):
+        set_jobserver(None)
+
+    def run_threads(self, server, cmds):
+        running = []
+        max_running = {}
+        lock = threading.Lock()
+
+        def run(cmd):
+            with server.job(cmd):
+                with lock:
+                    running.append(cmd[0])
+                    for tool in set(running):
+                        max_running[tool] = max(max_running.get(tool, 0), running.count(tool))
+                    max_running['all'] = max(max_running.get('all', 0), len(running))
+                time.sleep(0.05)
+                with lock:
+                    running.remove(cmd[0])
+
+        threads = [threading.Thread(target=run, args=(cmd,)) for cmd in cmds]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return max_running
+
+    def test_global_and_tool_limits(self):
+        server = JobServer(3, {'java': 1})
+        max_running = self.run_threads(server, [['java']] * 4 + [['lessc']] * 4)
+        assert max_running['all'] == 3
+        assert max_running['java'] == 1
+        stats = server.get_stats()
+        assert stats['jobs'] == 8
+        assert stats['waits'] > 0
+        assert stats['max_wait'] > 0
+
+    def test_from_settings(self):
+        assert JobServer.from_settings({}) is None
+        server = JobServer.from_settings({'tool_proc_limits': {'java': 2}})
+        assert server.limit is None
+        assert server.tool_limits == {'java': 2}
+
+    def test_shared_with_pool_workers(self):
+        server = JobServer(1)
+        pool = multiprocessing.Pool(4, initializer=set_jobserver, initargs=(server,))
+        try:
+            start = time.time()
+            pool.map(run_sleep, range(4))
+            elapsed = time.time() - start
+        finally:
+            pool.close()
+            pool.join()
+        assert elapsed >= 0.8, elapsed
+        assert server.get_stats()['jobs'] == 4
+        assert server.get_stats()['waits'] >= 2
+
+    def test_no_jobserver(self):
+        assert assetman.jobserver.jobserver is None
+        with assetman.jobserver.job(['java']):
+            pass
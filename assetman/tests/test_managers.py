@@ -0,0 +1,56 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from assetman.managers import JSManager, render_cache
+from assetman.manifest import Manifest
+from assetman.settings import Settings
+
+class TestAssetManagerRendering(unittest.TestCase):
+
+    def setUp(self):
+        self.compiled_asset_root = tempfile.mkdtemp(suffix='.assetman_tests')
+        self.settings = Settings(
+            compiled_asset_root=self.compiled_asset_root,
+            enable_static_compilation=False,
+            static_url_prefix='/static/',
+            local_cdn_url_prefix='/cdn/',
+            cdn_url_prefix=['//1.example.net/', '//2.example.net/'])
+        name_hash = JSManager('test.js', settings=self.settings).get_hash()
+        self.write_manifest({name_hash: {'version': 'abc', 'versioned_path': 'abc.js'}})
+        Manifest.invalidate_shared()
+        render_cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.compiled_asset_root)
+        Manifest.invalidate_shared()
+
+    def write_manifest(self, blocks):
+        with open(os.path.join(self.compiled_asset_root, 'manifest.json'), 'w') as f:
+            f.write(json.dumps(dict(blocks=blocks, assets={})))
+
+    def test_render_compiled_block(self):
+        result = JSManager.include('test.js', settings=self.settings, local=True)
+        assert result == '<script src="/cdn/abc.js" type="text/javascript"></script>', result
+
+    def test_repeated_renders_hit_render_cache(self):
+        first = JSManager.include('test.js', settings=self.settings)
+        second = JSManager.include('test.js', settings=self.settings)
+        assert first == second
+        stats = render_cache.stats()
+        assert stats['misses'] == 1, stats
+        assert stats['hits'] == 1, stats
+
+    def test_manifest_reload_bypasses_stale_renders(self):
+        JSManager.include('test.js', settings=self.settings, local=True)
+        name_hash = JSManager('test.js', settings=self.settings).get_hash()
+        self.write_manifest({name_hash: {'version': 'def', 'versioned_path': 'def.js'}})
+        Manifest.invalidate_shared(self.compiled_asset_root)
+
+        result = JSManager.include('test.js', settings=self.settings, local=True)
+        assert 'def.js' in result, result
+
+if __name__ == "__main__":
+    unittest.main()
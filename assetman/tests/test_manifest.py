@@ -3,7 +3,8 @@ import os
 import unittest
 import json
 
-from assetman.manifest import Manifest
+from assetman.manifest import Manifest, RuntimeManifest
+from assetman.manifest_index import ManifestIndex
 from assetman.settings import Settings
 
 class TestManifest(unittest.TestCase):
@@ -16,6 +17,9 @@ class TestManifest(unittest.TestCase):
 
     def tearDown(self):
         os.remove(self.TEST_MANIFEST_PATH + "manifest.json")
+        for filename in ("manifest.idx", "manifest.runtime.json"):
+            if os.path.exists(self.TEST_MANIFEST_PATH + filename):
+                os.remove(self.TEST_MANIFEST_PATH + filename)
  
     def test_can_open_manifest_path_from_settings(self):
         settings = Settings(compiled_asset_root=self.TEST_MANIFEST_PATH)
@@ -55,5 +59,84 @@ class TestManifest(unittest.TestCase):
             for k, v in list(manifest_json.items()):
                 assert manifest._manifest.get(k) == v
 
+    def test_write_increments_generation(self):
+        manifest = Manifest().load(self.TEST_MANIFEST_PATH)
+        assert manifest.generation == 0
+        manifest.write(compiled_asset_path=self.TEST_MANIFEST_PATH)
+        manifest.write(compiled_asset_path=self.TEST_MANIFEST_PATH)
+
+        manifest = Manifest().load(self.TEST_MANIFEST_PATH)
+        assert manifest.generation == 2
+        ManifestIndex.write(Manifest.wrap(dict(blocks={}, assets={}, generation=2)), self.TEST_MANIFEST_PATH)
+        assert ManifestIndex.read_generation(ManifestIndex.get_path(self.TEST_MANIFEST_PATH)) == 2
+
+    def test_can_write_compact_manifest(self):
+        manifest = Manifest().load(self.TEST_MANIFEST_PATH)
+        manifest.write(compiled_asset_path=self.TEST_MANIFEST_PATH, indent=None)
+
+        with open(self.TEST_MANIFEST_PATH + 'manifest.json') as manifest_file:
+            assert '\n' not in manifest_file.read()
+        assert not [f for f in os.listdir(self.TEST_MANIFEST_PATH) if f.startswith('.manifest.json')]
+
+    def test_shared_manifest_is_loaded_once(self):
+        settings = Settings(compiled_asset_root=self.TEST_MANIFEST_PATH)
+        Manifest.invalidate_shared()
+
+        manifest = Manifest.shared(settings)
+        assert list(manifest.blocks.keys())
+        assert Manifest.shared(settings) is manifest
+
+        Manifest.invalidate_shared(self.TEST_MANIFEST_PATH)
+        assert Manifest.shared(settings) is not manifest
+
+    def test_writing_manifest_invalidates_shared_manifest(self):
+        settings = Settings(compiled_asset_root=self.TEST_MANIFEST_PATH)
+        manifest = Manifest.shared(settings)
+
+        Manifest(settings).load().write()
+        assert Manifest.shared(settings) is not manifest
+
+    def test_manifest_index_lookups(self):
+        manifest = Manifest.wrap(dict(
+            blocks=dict(b1=dict(versioned_path='v1.js'), b2=dict(versioned_path='v2.css')),
+            assets={'img/a.png': dict(versioned_path='va.png'), u'img/\u00e9.png': dict(versioned_path='ve.png')}))
+        ManifestIndex.write(manifest, self.TEST_MANIFEST_PATH)
+
+        index = ManifestIndex(ManifestIndex.get_path(self.TEST_MANIFEST_PATH))
+        try:
+            assert index.get_block_path('b1') == 'v1.js'
+            assert index.get_block_path('b2') == 'v2.css'
+            assert index.get_asset_path('img/a.png') == 'va.png'
+            assert index.get_asset_path(u'img/\u00e9.png') == 've.png'
+            assert not index.has_asset('img/missing.png')
+            self.assertRaises(KeyError, index.get_block_path, 'b3')
+        finally:
+            index.close()
+
+    def test_shared_manifest_prefers_index(self):
+        settings = Settings(compiled_asset_root=self.TEST_MANIFEST_PATH)
+        manifest = Manifest.wrap(dict(blocks=dict(a=dict(versioned_path='a.js')), assets={}))
+        ManifestIndex.write(manifest, self.TEST_MANIFEST_PATH)
+        Manifest.invalidate_shared()
+
+        shared = Manifest.shared(settings)
+        assert isinstance(shared, ManifestIndex), shared
+        assert shared.get_block_path('a') == 'a.js'
+        Manifest.invalidate_shared()
+
+    def test_shared_manifest_prefers_runtime_manifest(self):
+        settings = Settings(compiled_asset_root=self.TEST_MANIFEST_PATH)
+        manifest = Manifest.wrap(dict(
+            blocks=dict(a=dict(version='1', versioned_path='a.js')),
+            assets={'a.png': dict(version='2', versioned_path='b.png', deps=[])}))
+        RuntimeManifest.write(manifest, self.TEST_MANIFEST_PATH)
+        Manifest.invalidate_shared()
+
+        shared = Manifest.shared(settings)
+        assert isinstance(shared, RuntimeManifest), shared
+        assert shared.get_block_path('a') == 'a.js'
+        assert shared.get_asset_path('a.png') == 'b.png'
+        Manifest.invalidate_shared()
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,6 +1,12 @@
+import os
+import json
+import shutil
+import tempfile
 import unittest
 
 from assetman.compilers import JSCompiler, CSSCompiler
+from assetman.manifest import Manifest
+from assetman.tornadoutils.template import AssetmanLoader
 from assetman.parsers.tornado_parser import TornadoParser
 import assetman.tools
 from assetman.settings import Settings
@@ -32,5 +38,56 @@ class TestTornadoTemplateParser(unittest.TestCase):
         assert JSCompiler in compiler_types, compilers
         assert CSSCompiler in compiler_types, compilers
 
+class TestAssetmanLoader(unittest.TestCase):
+
+    TEST_TEMPLATE_DIR = "assetman/tests/tornado_templates"
+
+    def setUp(self):
+        self.compiled_asset_root = tempfile.mkdtemp(suffix='.assetman_tests')
+        self.settings = Settings(
+            compiled_asset_root=self.compiled_asset_root,
+            static_dir="assetman/tests/static_dir",
+            enable_static_compilation=False,
+            static_url_prefix='/static/',
+            local_cdn_url_prefix='/cdn/',
+            cdn_url_prefix=['//1.example.net/'])
+        Manifest.invalidate_shared()
+
+    def tearDown(self):
+        shutil.rmtree(self.compiled_asset_root)
+        Manifest.invalidate_shared()
+
+    def write_manifest(self, version):
+        template_path = os.path.join(self.TEST_TEMPLATE_DIR, "tornado_test_template.html")
+        blocks = {}
+        for compiler in TornadoParser(template_path, self.settings).get_compilers():
+            blocks[compiler.get_hash()] = {
+                'version': version,
+                'versioned_path': '%s.%s' % (version, compiler.get_ext()),
+            }
+        with open(os.path.join(self.compiled_asset_root, 'manifest.json'), 'w') as f:
+            f.write(json.dumps(dict(blocks=blocks, assets={})))
+
+    def test_inlines_asset_blocks(self):
+        self.write_manifest('abc')
+        loader = AssetmanLoader(self.TEST_TEMPLATE_DIR, assetman_settings=self.settings)
+        template = loader.load("tornado_test_template.html")
+
+        assert 'assetman' not in template.code, template.code
+        result = template.generate().decode()
+        assert '<script src="//1.example.net/abc.js" type="text/javascript"></script>' in result, result
+        assert '<link href="//1.example.net/abc.css" rel="stylesheet" type="text/css">' in result, result
+
+    def test_manifest_reload_resets_templates(self):
+        self.write_manifest('abc')
+        loader = AssetmanLoader(self.TEST_TEMPLATE_DIR, assetman_settings=self.settings)
+        template = loader.load("tornado_test_template.html")
+
+        self.write_manifest('def')
+        Manifest.invalidate_shared(self.compiled_asset_root)
+        new_template = loader.load("tornado_test_template.html")
+        assert new_template is not template
+        assert b'def.js' in new_template.generate()
+
 if __name__ == "__main__":
     unittest.main()
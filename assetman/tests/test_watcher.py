@@ -0,0 +1,52 @@
+import os
+import json
+import shutil
+import tempfile
+
+import tornado.testing
+
+from assetman.manifest import Manifest
+from assetman.settings import Settings
+from assetman.tornadoutils.watcher import ManifestWatcher
+
+class TestManifestWatcher(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(TestManifestWatcher, self).setUp()
+        self.compiled_asset_root = tempfile.mkdtemp(suffix='.assetman_tests')
+        self.settings = Settings(compiled_asset_root=self.compiled_asset_root)
+        Manifest.invalidate_shared()
+
+    def tearDown(self):
+        shutil.rmtree(self.compiled_asset_root)
+        Manifest.invalidate_shared()
+        super(TestManifestWatcher, self).tearDown()
+
+    def write_manifest(self, blocks):
+        with open(os.path.join(self.compiled_asset_root, 'manifest.json'), 'w') as f:
+            f.write(json.dumps(dict(blocks=blocks, assets={})))
+
+    @tornado.testing.gen_test
+    def test_reloads_changed_manifest(self):
+        self.write_manifest(dict(a=dict(versioned_path='a1.js')))
+        watcher = ManifestWatcher(self.settings, io_loop=self.io_loop)
+
+        assert (yield watcher.check())
+        assert Manifest.shared(self.settings).get_block_path('a') == 'a1.js'
+        assert watcher.check() is None
+
+        self.write_manifest(dict(a=dict(versioned_path='a2.js')))
+        os.utime(Manifest(self.settings).get_path(), ns=(0, 1))
+        assert (yield watcher.check())
+        assert Manifest.shared(self.settings).get_block_path('a') == 'a2.js'
+
+    @tornado.testing.gen_test
+    def test_keeps_current_manifest_if_new_one_is_unreadable(self):
+        self.write_manifest(dict(a=dict(versioned_path='a1.js')))
+        watcher = ManifestWatcher(self.settings, io_loop=self.io_loop)
+        assert (yield watcher.check())
+
+        with open(Manifest(self.settings).get_path(), 'w') as f:
+            f.write('{"blocks": {"a": ')
+        assert not (yield watcher.check())
+        assert Manifest.shared(self.settings).get_block_path('a') == 'a1.js'
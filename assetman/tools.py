@@ -2,9 +2,12 @@
 
 import os
 import re
+import hashlib
 import binascii
 import itertools
 import logging
+import tempfile
+import contextlib
 
 # What to calls to assetman look like in {% apply %} blocks?
 include_expr_matcher = re.compile(r'^assetman\.(include_\w+)').match
@@ -52,6 +55,69 @@ def iter_template_paths(template_dirs, template_ext):
             for f in filter(template_file_matcher, files):
                 yield os.path.join(root, f)
 
+@contextlib.contextmanager
+def atomic_write(path, mode='w'):
+    """Yields a file object for replacing the contents of the file at path.
+    Everything is written to a temporary file in the same directory, which is
+    fsynced and renamed over path when the with block exits cleanly, so
+    readers only ever see the complete old or new contents. If the with block
+    raises, the temporary file is removed and path is left untouched.
+    """
+    dirname, basename = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.%s.' % basename)
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+def get_hash_algorithm(settings=None):
+    """Returns a name for the content hash algorithm configured by the given
+    settings, eg 'md5' or 'blake2b-16', suitable for recording alongside the
+    versions it produced.
+    """
+    settings = settings or {}
+    algorithm = settings.get('hash_algorithm') or 'md5'
+    digest_size = settings.get('hash_digest_size')
+    if digest_size:
+        return '%s-%d' % (algorithm, digest_size)
+    return algorithm
+
+def new_hash(settings=None, data=b''):
+    """Returns a new hash object for the content hash algorithm configured
+    by the `hash_algorithm` setting (md5 by default). Algorithms with a
+    variable digest size (eg blake2b) also honor the `hash_digest_size`
+    setting, in bytes.
+    """
+    settings = settings or {}
+    algorithm = settings.get('hash_algorithm') or 'md5'
+    digest_size = settings.get('hash_digest_size')
+    if digest_size:
+        return hashlib.new(algorithm, data, digest_size=digest_size)
+    return hashlib.new(algorithm, data)
+
+def check_hash_algorithm(settings):
+    """Raises a ValueError if the `hash_algorithm` and `hash_digest_size`
+    settings don't make a usable content hash, so a bad combination is
+    reported before the build starts rather than from deep inside it.
+    """
+    try:
+        h = new_hash(settings)
+    except TypeError:
+        raise ValueError('invalid hash algorithm %s: %s does not take a digest size'
+                         % (get_hash_algorithm(settings), settings.get('hash_algorithm') or 'md5'))
+    except ValueError as e:
+        raise ValueError('invalid hash algorithm %s: %s' % (get_hash_algorithm(settings), e))
+    if not h.digest_size:
+        raise ValueError('invalid hash algorithm %s: variable length digests are not supported'
+                         % get_hash_algorithm(settings))
+
 # Shortcuts for creating paths relative to some other path
 def make_absolute_static_path(static_dir, p):
     if os.path.exists(p):
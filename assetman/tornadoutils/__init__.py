@@ -1,2 +1,4 @@
 from .helpers import TemplateCommands
 from .static import StaticFileHandler, CompilingStaticHandler, LessCompilerHandler, SassCompilerHandler
+from .template import AssetmanLoader, AssetmanTemplate
+from .watcher import ManifestWatcher
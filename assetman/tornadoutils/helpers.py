@@ -1,10 +1,23 @@
 from assetman.managers import AssetManager, JSManager, CSSManager, LessManager, SassManager
+from assetman.manifest import Manifest
+from assetman.tornadoutils.watcher import ManifestWatcher
 import functools
 
 class TemplateCommands(object):
     def __init__(self, settings, local=None):
+        self.settings = settings
         self.include_js = functools.partial(JSManager.include, settings=settings, local=local)
         self.include_css = functools.partial(CSSManager.include, settings=settings, local=local)
         self.include_less = functools.partial(LessManager.include, settings=settings, local=local)
         self.include_sass = functools.partial(SassManager.include, settings=settings, local=local)
         self.static_url = AssetManager("", settings=settings).static_url
+
+    def invalidate_manifest(self):
+        """Drops the shared manifest so the next render reloads it from disk."""
+        Manifest.invalidate_shared(self.settings['compiled_asset_root'])
+
+    def watch_manifest(self, interval=5.0, io_loop=None):
+        """Starts watching the manifest for changes, hot-reloading it into
+        running processes. Returns the started ManifestWatcher.
+        """
+        return ManifestWatcher(self.settings, interval=interval, io_loop=io_loop).start()
@@ -0,0 +1,130 @@
+import os
+import ast
+import logging
+
+import tornado.template
+
+from assetman.managers import JSManager, CSSManager, LessManager, SassManager
+from assetman.manifest import Manifest
+from assetman.tools import include_expr_matcher
+
+# Map from template-side assetman manager calls to the corresponding manager
+# classes used to render them
+manager_map = {
+    'include_js': JSManager,
+    'include_css': CSSManager,
+    'include_less': LessManager,
+    'include_sass': SassManager,
+}
+
+
+class AssetmanTemplate(tornado.template.Template):
+    """A Tornado template whose {% apply assetman.include_* %} blocks are
+    rendered once, while the template is being compiled, and baked into the
+    generated code as literal markup.
+    """
+
+    def _generate_python(self, loader):
+        if isinstance(loader, AssetmanLoader):
+            loader.inline_asset_blocks(self.file, self.name)
+        return super(AssetmanTemplate, self)._generate_python(loader)
+
+
+class AssetmanLoader(tornado.template.Loader):
+    """An optional drop-in replacement for `tornado.template.Loader` which
+    uses the shared manifest to replace assetman blocks with their rendered
+    <script>/<link> elements at template compile time, so rendering a
+    template makes no assetman calls at all. Use it via the `template_loader`
+    application setting:
+
+        AssetmanLoader(template_path, assetman_settings=settings)
+
+    Any block that can't be resolved statically (because its arguments or
+    body aren't literals, or because rendering it fails) is left in place and
+    rendered normally. Compiled templates are discarded whenever the shared
+    manifest is reloaded.
+    """
+
+    def __init__(self, root_directory, assetman_settings=None, local=None, **kwargs):
+        super(AssetmanLoader, self).__init__(root_directory, **kwargs)
+        assert assetman_settings
+        self.assetman_settings = assetman_settings
+        self.local = local
+        self._manifest_load_id = None
+
+    def get_manifest_load_id(self):
+        if self.assetman_settings['enable_static_compilation']:
+            return None
+        return Manifest.shared(self.assetman_settings).load_id
+
+    def load(self, name, parent_path=None):
+        load_id = self.get_manifest_load_id()
+        if load_id != self._manifest_load_id:
+            with self.lock:
+                logging.debug('Manifest reloaded (%s -> %s), resetting templates',
+                              self._manifest_load_id, load_id)
+                self.templates = {}
+                self._manifest_load_id = load_id
+        return super(AssetmanLoader, self).load(name, parent_path)
+
+    def _create_template(self, name):
+        with open(os.path.join(self.root, name), 'rb') as f:
+            return AssetmanTemplate(f.read(), name=name, loader=self)
+
+    def inline_asset_blocks(self, node, template_name):
+        """Walks the parsed template tree rooted at node, replacing every
+        assetman block that can be rendered statically with a _Text node.
+        """
+        if isinstance(node, tornado.template._ChunkList):
+            for i, chunk in enumerate(node.chunks):
+                rendered = self.render_asset_block(chunk, template_name)
+                if rendered is not None:
+                    node.chunks[i] = tornado.template._Text(rendered, chunk.line, 'all')
+        for child in node.each_child():
+            self.inline_asset_blocks(child, template_name)
+
+    def render_asset_block(self, node, template_name):
+        """Returns the rendered output for the given template node if it is an
+        assetman block that can be rendered at compile time, else None.
+        """
+        if not isinstance(node, tornado.template._ApplyBlock):
+            return None
+        match = include_expr_matcher(node.method)
+        if not match or match.group(1) not in manager_map:
+            return None
+        kwargs = self.parse_block_kwargs(node.method)
+        if kwargs is None:
+            return None
+        if not all(isinstance(child, tornado.template._Text) for child in node.body.each_child()):
+            return None
+        text = ''.join(child.value for child in node.body.each_child())
+        kwargs.setdefault('local', self.local)
+        manager_cls = manager_map[match.group(1)]
+        try:
+            return manager_cls(text, settings=self.assetman_settings, src_path=template_name, **kwargs).render()
+        except Exception as e:
+            logging.warning('Not inlining %s block in %s: %r', match.group(1), template_name, e)
+            return None
+
+    def parse_block_kwargs(self, method):
+        """Parses the keyword arguments from an assetman block's method
+        expression, eg `assetman.include_js(local=True)`. Returns None if the
+        expression contains anything but literal keyword arguments.
+        """
+        try:
+            expr = ast.parse(method.strip(), mode='eval').body
+        except SyntaxError:
+            return None
+        if isinstance(expr, ast.Attribute):
+            return {}
+        if not isinstance(expr, ast.Call) or expr.args:
+            return None
+        kwargs = {}
+        for keyword in expr.keywords:
+            if keyword.arg is None:
+                return None
+            try:
+                kwargs[keyword.arg] = ast.literal_eval(keyword.value)
+            except (ValueError, TypeError, SyntaxError):
+                return None
+        return kwargs
@@ -0,0 +1,99 @@
+import os
+import logging
+
+import tornado.gen
+import tornado.ioloop
+
+from assetman.manifest import Manifest, RuntimeManifest, load_runtime_manifest, shared_manifests
+from assetman.manifest_index import ManifestIndex
+
+
+class ManifestWatcher(object):
+    """Periodically checks whether the manifest files in a compiled asset
+    root have changed and, if so, reloads the shared manifest without
+    restarting the process.
+
+    Changes are detected by comparing the inode, mtime and size of each
+    manifest file. If the manifest index's header shows the same generation
+    as the manifest already loaded, nothing is reloaded. New manifests are
+    parsed on the IOLoop's executor and atomically swapped into the shared
+    manifest registry, so renders never block on a reload. A manifest that
+    fails to load (eg, because it is only partially written) is ignored and
+    retried on the next check.
+    """
+
+    def __init__(self, settings, interval=5.0, io_loop=None):
+        self.settings = settings
+        self.interval = interval
+        self.io_loop = io_loop
+        self._signature = None
+        self._reloading = False
+        self._periodic_callback = None
+
+    def get_paths(self):
+        compiled_asset_root = self.settings['compiled_asset_root']
+        return [
+            Manifest(self.settings).get_path(),
+            RuntimeManifest.get_path(compiled_asset_root),
+            ManifestIndex.get_path(compiled_asset_root),
+        ]
+
+    def get_signature(self):
+        signature = []
+        for path in self.get_paths():
+            try:
+                st = os.stat(path)
+            except OSError:
+                signature.append(None)
+            else:
+                signature.append((st.st_ino, st.st_mtime_ns, st.st_size))
+        return tuple(signature)
+
+    def start(self):
+        io_loop = self.io_loop or tornado.ioloop.IOLoop.current()
+        self._periodic_callback = tornado.ioloop.PeriodicCallback(self.check, self.interval * 1000)
+        io_loop.add_callback(self._periodic_callback.start)
+        io_loop.add_callback(self.check)
+        return self
+
+    def stop(self):
+        if self._periodic_callback is not None:
+            self._periodic_callback.stop()
+            self._periodic_callback = None
+
+    def check(self):
+        """Starts reloading the manifest if it changed since the last check.
+        Returns a Future resolving to True if a new manifest was swapped in,
+        or None if no reload was started.
+        """
+        if self._reloading:
+            return None
+        signature = self.get_signature()
+        if signature == self._signature:
+            return None
+        current = shared_manifests.get_loaded(self.settings['compiled_asset_root'])
+        generation = ManifestIndex.read_generation(ManifestIndex.get_path(self.settings['compiled_asset_root']))
+        if current is not None and generation and generation == current.generation:
+            logging.debug('Manifest generation %d is already loaded', generation)
+            self._signature = signature
+            return None
+        self._reloading = True
+        io_loop = self.io_loop or tornado.ioloop.IOLoop.current()
+        future = io_loop.run_in_executor(None, load_runtime_manifest, self.settings)
+        return tornado.gen.convert_yielded(self._swap(future, signature))
+
+    async def _swap(self, future, signature):
+        try:
+            manifest = await future
+        except Exception:
+            logging.exception('Error reloading manifest from %s', self.settings['compiled_asset_root'])
+            return False
+        finally:
+            self._reloading = False
+        if manifest.is_empty():
+            logging.warning('Not reloading empty manifest from %s', self.settings['compiled_asset_root'])
+            return False
+        shared_manifests.replace(self.settings['compiled_asset_root'], manifest)
+        self._signature = signature
+        logging.info('Reloaded manifest %s (generation %d)', manifest, manifest.generation)
+        return True
@@ -0,0 +1,83 @@
+"""Measures how many bytes are pickled to send compile tasks to the pool
+workers, comparing compilers that carry the whole manifest (as they used to)
+with compilers that carry only their own manifest entries.
+
+Each task sent by pool.imap_unordered pickles both the CompileWorker and the
+compiler, so that is what is measured here.
+
+    PYTHONPATH=. python benchmarks/bench_compile_ipc.py --assets 50000 --blocks 200
+"""
+
+import os
+import time
+import pickle
+import shutil
+import tempfile
+from optparse import OptionParser
+
+from assetman.compile import CompileWorker
+from assetman.compilers import JSCompiler
+from assetman.manifest import Manifest
+from assetman.settings import Settings
+
+
+def make_manifest(settings, n_assets, n_blocks, files_per_block):
+    manifest = Manifest(settings)
+    for i in range(n_assets):
+        manifest.assets['js/f%d.js' % i] = {
+            'version': '%032x' % i,
+            'versioned_path': '%032x.js' % i,
+            'deps': ['img/i%d.png' % i],
+        }
+    compilers = []
+    for i in range(n_blocks):
+        paths = ['js/f%d.js' % ((i * files_per_block + j) % n_assets) for j in range(files_per_block)]
+        compiler = JSCompiler(' '.join(paths), settings=settings)
+        manifest.blocks[compiler.get_hash()] = {'version': '%032x' % i, 'versioned_path': '%032x.js' % i}
+        compilers.append(compiler)
+    return manifest, compilers
+
+
+def measure(worker, compilers):
+    start = time.time()
+    total = sum(len(pickle.dumps((worker, compiler), pickle.HIGHEST_PROTOCOL)) for compiler in compilers)
+    return total, time.time() - start
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--assets', type='int', default=50000)
+    parser.add_option('--blocks', type='int', default=200)
+    parser.add_option('--files-per-block', type='int', default=10)
+    options, args = parser.parse_args()
+
+    static_dir = tempfile.mkdtemp(suffix='.assetman_bench')
+    try:
+        os.mkdir(os.path.join(static_dir, 'js'))
+        for i in range(min(options.assets, options.blocks * options.files_per_block)):
+            open(os.path.join(static_dir, 'js', 'f%d.js' % i), 'w').close()
+        settings = Settings(static_dir=static_dir, compiled_asset_root=static_dir, static_url_prefix='/static/')
+        manifest, compilers = make_manifest(settings, options.assets, options.blocks, options.files_per_block)
+
+        # Before: the worker and every compiler held the whole manifest
+        worker = CompileWorker(False)
+        worker.manifest = manifest
+        for compiler in compilers:
+            compiler.manifest = manifest
+        before, before_time = measure(worker, compilers)
+
+        # After: each compiler only holds its own entries
+        worker = CompileWorker(False)
+        for compiler in compilers:
+            compiler.manifest = compiler.get_manifest_subset(manifest)
+        after, after_time = measure(worker, compilers)
+
+        print('%d tasks, manifest with %d assets' % (len(compilers), options.assets))
+        print('whole manifest:  %10d bytes pickled (%.2fs)' % (before, before_time))
+        print('manifest subset: %10d bytes pickled (%.2fs)' % (after, after_time))
+    finally:
+        shutil.rmtree(static_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Compares content hashing throughput for different hash algorithms, and for
+the old 8 KB block reads against get_file_hash's single read/mmap strategy.
+
+Hashes every file under --path (eg, a real static tree), or a synthetic tree
+of --files files of --size-kb each if no path is given.
+
+    PYTHONPATH=. python benchmarks/bench_hash.py --path /path/to/static
+    PYTHONPATH=. python benchmarks/bench_hash.py --files 200 --size-kb 4096
+"""
+
+import os
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+
+import assetman.compile
+from assetman.tools import new_hash
+
+
+def make_tree(root, n_files, size):
+    for i in range(n_files):
+        with open(os.path.join(root, 'f%d.bin' % i), 'wb') as f:
+            f.write(os.urandom(size))
+
+
+def iter_files(root):
+    for dirpath, dirs, files in os.walk(root):
+        for f in files:
+            yield os.path.join(dirpath, f)
+
+
+def block_file_hash(path, settings, block_size=8192):
+    """The previous implementation of get_file_hash, for comparison."""
+    h = new_hash(settings)
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def run(paths, hash_file, settings):
+    start = time.time()
+    for path in paths:
+        hash_file(path, settings)
+    return time.time() - start
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--path', type='string', help='Hash the files under this directory')
+    parser.add_option('--files', type='int', default=100)
+    parser.add_option('--size-kb', type='int', default=2048)
+    parser.add_option('--algorithms', type='string', default='md5,sha1,blake2b,blake2b-16,blake2s',
+                      help='Comma-separated list; a -N suffix sets the digest size')
+    options, args = parser.parse_args()
+
+    tmp_dir = None
+    root = options.path
+    if root is None:
+        root = tmp_dir = tempfile.mkdtemp(suffix='.assetman_bench')
+        make_tree(root, options.files, options.size_kb * 1024)
+    try:
+        paths = list(iter_files(root))
+        total_mb = sum(os.path.getsize(path) for path in paths) / float(1 << 20)
+        print('hashing %d files, %.1f MB' % (len(paths), total_mb))
+        # Warm the page cache so we compare hashing rather than disk reads
+        run(paths, block_file_hash, {})
+        for spec in options.algorithms.split(','):
+            algorithm, _, digest_size = spec.partition('-')
+            settings = {'hash_algorithm': algorithm, 'hash_digest_size': int(digest_size) if digest_size else None}
+            old = run(paths, block_file_hash, settings)
+            new = run(paths, assetman.compile.get_file_hash, settings)
+            print('%-12s 8KB blocks: %7.1f MB/s   get_file_hash: %7.1f MB/s (%.2fx)' % (
+                spec, total_mb / old, total_mb / new, old / new))
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Compares serial and thread-pool dependency scanning in build_manifest.
+
+Generates a synthetic static tree of CSS files which import each other and
+reference images, then times _build_manifest_helper with and without a
+thread pool. Use --latency-ms to simulate a slow (eg, network) filesystem by
+adding a delay to every file read.
+
+    PYTHONPATH=. python benchmarks/bench_scan.py --files 2000 --latency-ms 2
+"""
+
+import os
+import time
+import shutil
+import logging
+import tempfile
+import functools
+import concurrent.futures
+from optparse import OptionParser
+
+import assetman.compile
+from assetman.manifest import Manifest
+from assetman.settings import Settings
+
+
+def make_tree(static_dir, n_files, fanout=3):
+    for i in range(n_files):
+        imports = ''.join('@import "c%d.css";\n' % ((i * fanout + j) % n_files)
+                          for j in range(1, fanout + 1) if i * fanout + j < n_files)
+        with open(os.path.join(static_dir, 'c%d.css' % i), 'w') as f:
+            f.write(imports)
+            f.write('.c%d { background: url(/static/i%d.png); }\n' % (i, i))
+            f.write('/* %s */\n' % ('x' * 4096))
+        with open(os.path.join(static_dir, 'i%d.png' % i), 'wb') as f:
+            f.write(os.urandom(2048))
+
+
+def with_latency(fn, latency):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        time.sleep(latency)
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+def run(static_dir, threads):
+    settings = Settings(static_dir=static_dir, compiled_asset_root=static_dir, static_url_prefix='/static/')
+    manifest = Manifest(settings)
+    paths = [os.path.join(static_dir, 'c0.css')]
+    start = time.time()
+    if threads == 1:
+        count = assetman.compile._build_manifest_helper(static_dir, paths, '/static/', manifest, file_hashes={})
+    else:
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            count = assetman.compile._build_manifest_helper(static_dir, paths, '/static/', manifest, file_hashes={}, executor=executor)
+    return count, time.time() - start
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--files', type='int', default=2000)
+    parser.add_option('--threads', type='int', default=16)
+    parser.add_option('--latency-ms', type='float', default=0)
+    options, args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if options.latency_ms:
+        latency = options.latency_ms / 1000.0
+        assetman.compile.scan_file = with_latency(assetman.compile.scan_file, latency)
+
+    static_dir = tempfile.mkdtemp(suffix='.assetman_bench')
+    try:
+        make_tree(static_dir, options.files)
+        count, serial = run(static_dir, 1)
+        _, threaded = run(static_dir, options.threads)
+        print('scanned %d files (latency %.1fms)' % (count, options.latency_ms))
+        print('serial:      %.3fs' % serial)
+        print('%2d threads:  %.3fs (%.1fx)' % (options.threads, threaded, serial / threaded))
+    finally:
+        shutil.rmtree(static_dir)
+
+
+if __name__ == '__main__':
+    main()